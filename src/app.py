@@ -1,14 +1,25 @@
 import os
 import streamlit as st
-from utils.video_utils import save_video
 from utils.tts import SpeechTextConverter
-from core import get_explanations, generate_video, CACHE_DIR
+from utils.profiling import start_metrics_server
+from utils.media_server import start_media_server
+from core import (
+    get_explanations,
+    get_cache_dir,
+    VideoJob,
+    PROJECT_DIR,
+    TTS_CACHE,
+    TTS_WORKERS,
+    TTS_TORCH_THREADS
+)
 from helper import (
     get_app_styling,
     read_logo_image,
     get_files_types,
     copy_local_folder,
+    publish_video,
     is_valid_github_repo_url,
+    PUBLISHED_VIDEOS_DIR,
     clone_github_repo
 )
 # to avoid torch error
@@ -27,10 +38,20 @@ st.set_page_config(
 st.markdown(f"<style>{get_app_styling()}</style>", unsafe_allow_html=True)
 
 
+# metrics endpoint (METRICS_PORT) & video server (MEDIA_PORT), started once per process
+start_metrics_server()
+start_media_server(PUBLISHED_VIDEOS_DIR)
+
+
 # INITIALIZE TTS
 @st.cache_resource
 def init_tts(speed: float=1.0):
-    return SpeechTextConverter(speed=speed)
+    return SpeechTextConverter(
+        speed=speed,
+        cache=TTS_CACHE,
+        num_workers=TTS_WORKERS,
+        torch_threads=TTS_TORCH_THREADS
+    )
 
 
 # INITIALIZE session state
@@ -54,8 +75,12 @@ if 'project_title' not in st.session_state:
     st.session_state.project_title = ""
 if 'project_subtitle' not in st.session_state:
     st.session_state.project_subtitle = ""
-if 'video_bytes' not in st.session_state:
-    st.session_state.video_bytes = None
+if 'video_url' not in st.session_state:
+    st.session_state.video_url = None
+if 'video_job' not in st.session_state:
+    st.session_state.video_job = None
+if 'cache_dir' not in st.session_state:
+    st.session_state.cache_dir = None
 
 
 # main container, we'll be used to wrap each step block
@@ -112,6 +137,29 @@ def display_progress_bar():
     st.markdown('</div>', unsafe_allow_html=True)
 
 
+# VIDEO JOB PROGRESS
+VIDEO_JOB_STAGES = {'images': 'Slides', 'audios': 'Voice', 'segments': 'Encoding'}
+@st.fragment(run_every=1)
+def display_video_job():
+    """Refreshed every second while the video is generated in the background (the rest of the page is not rerun)"""
+    job = st.session_state.video_job
+    status, progress = job.snapshot()
+    for stage, label in VIDEO_JOB_STAGES.items():
+        event = progress.get(stage)
+        if event:
+            st.progress(
+                event['done'] / event['total'] if event['total'] else 1.0,
+                text=f"{label}: {event['done']}/{event['total']}"
+            )
+    if status != 'running':
+        # show the result
+        st.rerun()
+    if job.cancel_event.is_set():
+        st.markdown("<div class='info-text'>Cancelling after the current slides...</div>", unsafe_allow_html=True)
+    elif st.button("Cancel", key="cancel_video"):
+        job.cancel()
+
+
 # HEADER
 st.markdown(f"<div class='logo-header'>{load_and_display_logo()}</div>", unsafe_allow_html=True)
 display_progress_bar()
@@ -249,10 +297,18 @@ elif st.session_state.step == 5:
                 go_to_step(4)
         with col2:
             if st.button("Generate Explanations", key="generate_explanations"):
+                # workspace of this project & settings, reused by later runs
+                st.session_state.cache_dir = get_cache_dir(
+                    PROJECT_DIR,
+                    ignored_files=st.session_state.ignored_filetypes,
+                    num=st.session_state.num_explanations,
+                    user_instructions=st.session_state.custom_prompt
+                )
                 st.session_state.explanations = get_explanations(
                     num=st.session_state.num_explanations,
                     ignored_files=st.session_state.ignored_filetypes,
-                    user_instructions=st.session_state.custom_prompt
+                    user_instructions=st.session_state.custom_prompt,
+                    cache_dir=st.session_state.cache_dir
                 )
                 go_to_step(6)
 
@@ -324,29 +380,38 @@ elif st.session_state.step == 7:
         with st.container():
             st.markdown("<div class='info-text'>Click the button below to generate a video explanation of your code.</div>", unsafe_allow_html=True)
             
-            if st.button("Generate Video", key="generate_video"):
-                with st.spinner("Generating video..."):
-                    # try:
-                        tts = init_tts(speed=st.session_state.voice_speed)
-                        # Call the video generation function
-                        video = generate_video(
-                            tts,
-                            st.session_state.explanations,
-                            st.session_state.project_title,
-                            st.session_state.project_subtitle
-                        )
-                        video_path = f"{CACHE_DIR}{st.session_state.project_title}.mp4"
-                        save_video(video, video_path)
-                        st.success(f"Video generated successfully at: {video_path}")
-                        
-                        # Display the video
-                        video_file = open(video_path, 'rb')
-                        video_bytes = video_file.read()
-                        st.session_state.video_bytes = video_bytes
-                    # except Exception as e:
-                    #     st.error(f"Error generating video: {str(e)}")
-            if st.session_state.video_bytes:
-                st.video(st.session_state.video_bytes)
+            job = st.session_state.video_job
+            if job is not None and job.snapshot()[0] == 'running':
+                display_video_job()
+            else:
+                if job is not None:
+                    # the job finished since the last run, its result is reported once
+                    if job.status == 'done':
+                        st.session_state.video_url = publish_video(job.output_path)
+                        st.success(f"Video generated successfully at: {job.output_path}")
+                    elif job.status == 'cancelled':
+                        st.warning("Video generation cancelled")
+                    else:
+                        st.error(f"Error generating video: {job.error}")
+                    st.session_state.video_job = None
+                if st.button("Generate Video", key="generate_video"):
+                    st.session_state.video_url = None
+                    # runs in the background, progress is polled by display_video_job
+                    st.session_state.video_job = VideoJob(
+                        init_tts(speed=st.session_state.voice_speed),
+                        [dict(explanation) for explanation in st.session_state.explanations],
+                        st.session_state.project_title,
+                        st.session_state.project_subtitle,
+                        f"{st.session_state.cache_dir}{st.session_state.project_title}.mp4",
+                        cache_dir=st.session_state.cache_dir
+                    )
+                    st.rerun()
+            if st.session_state.video_url:
+                # streamed by the media server (range requests), the video is never loaded by the app
+                st.markdown(
+                    f'<video controls style="width: 100%;" src="{st.session_state.video_url}"></video>',
+                    unsafe_allow_html=True
+                )
                 st.markdown("</div>", unsafe_allow_html=True)
                 
                 # Navigation button to go back
@@ -355,13 +420,12 @@ elif st.session_state.step == 7:
                     if st.button("Back to Explanations", key="back_to_step6"):
                         go_to_step(6)
                 with col2:
-                    # Create a download button
+                    # Create a download link
                     st.markdown("<h3>Download Your Tutorial</h3>", unsafe_allow_html=True)
                     st.markdown("<p>Your code explanation video is ready!</p>", unsafe_allow_html=True)
-                    st.download_button(
-                        label="DOWNLOAD VIDEO",
-                        data=st.session_state.video_bytes,
-                        file_name="code_explainer_tutorial.mp4",
-                        mime="video/mp4"
+                    st.markdown(
+                        f'<a class="download-button" href="{st.session_state.video_url}?download" '
+                        'download="code_explainer_tutorial.mp4">DOWNLOAD VIDEO</a>',
+                        unsafe_allow_html=True
                     )
                     st.markdown("</div>", unsafe_allow_html=True)
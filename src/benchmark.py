@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+# the benchmark never touches the network
+os.environ.setdefault('LLM_BACKEND', 'stub')
+import core
+from utils.cache import DiskCache
+from utils.tts import StubSpeechTextConverter
+from utils.video_utils import merge_all, save_video, encode_segments, concat_segments
+from utils.explainer import explain_codebase, add_highlighting
+from utils.explainer.llms import StubLLM
+from utils.explainer.codebase_parser import get_codebase, ingest_codebase
+
+
+"""
+Offline end-to-end benchmark: synthetic repositories, stub llm & tts.
+Reports per stage latency percentiles, throughput & peak memory, and exits with 1
+when a stage is slower (or bigger) than the stored baseline by more than the threshold.
+"""
+
+
+REPO_SIZES = (10, 1_000, 20_000)
+NUM_EXPLANATIONS = 20
+# stage differences under this many seconds are noise, never regressions
+MIN_SECONDS = 0.05
+LANGUAGES = {
+    'py': 'def {name}(value):\n    """Returns {name} of value"""\n    result = value * {i}\n    return result\n',
+    'js': 'export function {name}(value) {{\n  // {name} of value\n  return value * {i};\n}}\n',
+    'md': '## {name}\n\nNotes about {name}, section {i}.\n',
+}
+
+
+def generate_repo(repo_dir: str, num_files: int, seed: int=0) -> str:
+    """Writes a deterministic repo: nested folders, a few languages, binaries & ignored folders"""
+    marker = os.path.join(repo_dir, '.complete')
+    if os.path.exists(marker):
+        return repo_dir
+    rng = random.Random(seed)
+    for i in range(num_files):
+        folder = os.path.join(repo_dir, *(f'pkg{rng.randrange(10)}' for _ in range(rng.randrange(4))))
+        os.makedirs(folder, exist_ok=True)
+        if i % 50 == 49:
+            with open(os.path.join(folder, f'asset{i}.bin'), 'wb') as f:
+                f.write(rng.randbytes(2048))
+            continue
+        extension = rng.choice(list(LANGUAGES))
+        name = f'module_{i}'
+        body = ''.join(LANGUAGES[extension].format(name=f'{name}_{j}', i=j) for j in range(rng.randrange(1, 40)))
+        with open(os.path.join(folder, f'{name}.{extension}'), 'w', encoding='utf-8') as f:
+            f.write(body)
+    # folders the parser must skip
+    os.makedirs(os.path.join(repo_dir, 'node_modules', 'dep'), exist_ok=True)
+    with open(os.path.join(repo_dir, 'node_modules', 'dep', 'index.js'), 'w') as f:
+        f.write('module.exports = {};\n')
+    with open(os.path.join(repo_dir, '.gitignore'), 'w') as f:
+        f.write('*.log\nbuild/\n')
+    open(marker, 'w').close()
+    return repo_dir
+
+
+def measure(function, repeats: int) -> dict:
+    """Runs function repeats times, then once more under tracemalloc for its peak memory"""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'p50': float(np.percentile(latencies, 50)),
+        'p95': float(np.percentile(latencies, 95)),
+        'peak_memory': peak,
+        'result': result,
+    }
+
+
+def run_repo(repo_dir: str, work_dir: str, repeats: int, encode: bool) -> dict:
+    llm = StubLLM()
+    tts = StubSpeechTextConverter()
+    cache_dir = os.path.join(work_dir, 'workspace') + '/'
+    os.makedirs(cache_dir, exist_ok=True)
+    num_files = len(ingest_codebase(repo_dir).files)
+    stages = {}
+
+    def explain() -> list[dict]:
+        snapshot = ingest_codebase(repo_dir, ignored_files=[])
+        explanations = explain_codebase(repo_dir, [], NUM_EXPLANATIONS, snapshot=snapshot, llm=llm)
+        return add_highlighting(repo_dir, [], explanations, snapshot=snapshot, llm=llm)
+
+    stages['ingest'] = measure(lambda: get_codebase(repo_dir), repeats), num_files
+    stages['explain'] = measure(explain, repeats), NUM_EXPLANATIONS
+    explanations = stages['explain'][0]['result']
+    stages['audios'] = measure(
+        lambda: asyncio.run(core._generate_audios(tts, explanations, cache_dir)), repeats
+    ), len(explanations)
+    stages['images'] = measure(
+        lambda: asyncio.run(core._generate_images(explanations, 'Benchmark', 'synthetic repo', repo_dir, cache_dir)),
+        repeats
+    ), len(explanations)
+    image_paths = stages['images'][0]['result']
+    audios, sr = stages['audios'][0]['result']
+    output_path = os.path.join(work_dir, 'video.mp4')
+    if encode:
+        stages['moviepy'] = measure(
+            lambda: save_video(merge_all(audios, image_paths, sr), output_path), repeats
+        ), len(explanations)
+    segment_paths = [os.path.join(work_dir, f'segment_{i}.mp4') for i in range(len(image_paths))]
+    stages['segments'] = measure(
+        lambda: concat_segments(
+            encode_segments(image_paths, audios, sr, segment_paths, core.ENCODE_CONCURRENCY), output_path
+        ),
+        repeats
+    ), len(explanations)
+    report = {}
+    for stage, (measures, items) in stages.items():
+        report[stage] = {
+            'p50': round(measures['p50'], 4),
+            'p95': round(measures['p95'], 4),
+            'throughput': round(items / measures['p50'], 2) if measures['p50'] else None,
+            'peak_memory': measures['peak_memory'],
+        }
+    return report
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Returns the regressions of results against baseline (p50 & peak memory)"""
+    regressions = []
+    for repo, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get(repo, {}).get(stage)
+            if previous is None:
+                continue
+            if current['p50'] - previous['p50'] > MIN_SECONDS and current['p50'] > previous['p50'] * (1 + threshold):
+                regressions.append(f'{repo}/{stage}: p50 {previous["p50"]}s -> {current["p50"]}s')
+            if current['peak_memory'] > previous['peak_memory'] * (1 + threshold):
+                regressions.append(
+                    f'{repo}/{stage}: peak memory {previous["peak_memory"]} -> {current["peak_memory"]} bytes'
+                )
+    return regressions
+
+
+def print_report(results: dict) -> None:
+    print(f'{"repo":>8} {"stage":>10} {"p50 (s)":>10} {"p95 (s)":>10} {"items/s":>10} {"peak (MB)":>10}')
+    for repo, stages in results.items():
+        for stage, r in stages.items():
+            print(
+                f'{repo:>8} {stage:>10} {r["p50"]:>10.4f} {r["p95"]:>10.4f} '
+                f'{r["throughput"] or 0:>10.2f} {r["peak_memory"] / 1024 ** 2:>10.2f}'
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the video pipeline on synthetic repositories')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(REPO_SIZES), help='number of files per repo')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--repos-dir', default=os.path.join(tempfile.gettempdir(), 'cevaig_benchmark_repos'))
+    parser.add_argument('--output', help='write the results (json) to this file')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--save-baseline', help='write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown ratio before failing')
+    parser.add_argument('--moviepy', action='store_true', help='also benchmark the moviepy encoder (slow)')
+    args = parser.parse_args()
+    results = {}
+    for size in args.sizes:
+        repo_dir = generate_repo(os.path.join(args.repos_dir, f'repo_{size}'), size)
+        with tempfile.TemporaryDirectory(prefix='cevaig_benchmark_') as work_dir:
+            # measure rendering, not persistent cache hits: these caches evict everything they store
+            core.SCREENSHOT_CACHE = DiskCache(os.path.join(work_dir, 'screenshots'), max_bytes=0)
+            core.SLIDE_CACHE = DiskCache(os.path.join(work_dir, 'slides'), max_bytes=0)
+            print(f'Benchmarking repo of {size} files')
+            results[str(size)] = run_repo(repo_dir, work_dir, args.repeats, args.moviepy)
+    print_report(results)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression over {args.threshold:.0%} against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
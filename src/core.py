@@ -1,15 +1,28 @@
 import os
 import json
-import random
+import hashlib
 import asyncio
-import numpy as np
+import threading
+from typing import Callable
 from PIL import Image
-from utils.video_utils import merge_all
-from utils.tts import SpeechTextConverter, preprocess_text, save_audio_to_file
+from utils.cache import DiskCache, Manifest, lock_dir, collect_garbage
+from utils.video_utils import (
+    merge_all,
+    save_video,
+    encode_slideshow,
+    encode_segments,
+    concat_segments,
+    open_audio_encoder,
+    FrameStore
+)
+from utils.tts import SpeechTextConverter, preprocess_text, SAMPLE_RATE
 from utils.creator.screenshotter import create_screenshot
-from utils.explainer import explain_codebase, add_highlighting
-from utils.explainer.codebase_parser import generate_codebase_tree
+from utils.explainer import explain_codebase, add_highlighting, stream_explanations
+from utils.explainer.llms import get_llm, LLM_BACKEND, LLM_STATS
+from utils.explainer.codebase_parser import generate_codebase_tree, ingest_codebase, ProjectIndex
 from utils.creator.drawer import draw_project_cover, draw_project_tree
+from utils.profiling import span
+from utils.limits import limit
 
 
 # DEFINE DIRS
@@ -20,9 +33,106 @@ os.path.exists(PROJECT_DIR) or os.makedirs(PROJECT_DIR)
 # where we store static files like images
 STATIC_DIR = f'{curr_dir}/static'
 os.path.exists(STATIC_DIR) or os.makedirs(STATIC_DIR)
-# temp dir for caching explanations & screenshots
-CACHE_DIR = f'{curr_dir}/temp/test_{random.randint(0, 10000)}/'
-os.path.exists(CACHE_DIR) or os.makedirs(CACHE_DIR)
+# workspaces (explanations, frames, audios, segments & videos), one per project content & run config
+WORKSPACES_DIR = f'{curr_dir}/temp/workspaces'
+WORKSPACES_MAX_BYTES = int(os.getenv('WORKSPACES_MAX_BYTES', 10 * 1024 ** 3))
+# persisted project indexes, one per project dir
+INDEX_DIR = f'{curr_dir}/temp/index'
+# max number of slides rendered at the same time
+SCREENSHOT_CONCURRENCY = int(os.getenv('SCREENSHOT_CONCURRENCY', os.cpu_count() or 4))
+# how code slides are rendered: 'native' (in-process) or 'carbon' (carbon-now cli)
+SCREENSHOT_BACKEND = os.getenv('SCREENSHOT_BACKEND', 'native')
+# how the final video is encoded:
+# 'segments' (one segment per slide encoded in parallel, then concatenated),
+# 'slideshow' (each slide fed once to a single ffmpeg) or 'moviepy'
+VIDEO_ENCODER = os.getenv('VIDEO_ENCODER', 'segments')
+# max number of segments encoded at the same time
+ENCODE_CONCURRENCY = int(os.getenv('ENCODE_CONCURRENCY', os.cpu_count() or 4))
+# tts worker processes & torch threads per worker, keep workers * threads <= cores
+TTS_WORKERS = int(os.getenv('TTS_WORKERS', 1))
+TTS_TORCH_THREADS = int(os.getenv('TTS_TORCH_THREADS', 0)) or None
+# persistent caches, shared between runs
+PERSISTENT_CACHE_DIR = f'{curr_dir}/temp/cache'
+SCREENSHOT_CACHE = DiskCache(
+    f'{PERSISTENT_CACHE_DIR}/screenshots',
+    max_bytes=int(os.getenv('SCREENSHOT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+)
+SLIDE_CACHE = DiskCache(
+    f'{PERSISTENT_CACHE_DIR}/slides',
+    max_bytes=int(os.getenv('SLIDE_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+)
+LLM_CACHE = DiskCache(
+    f'{PERSISTENT_CACHE_DIR}/llm',
+    max_bytes=int(os.getenv('LLM_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+)
+TTS_CACHE = DiskCache(
+    f'{PERSISTENT_CACHE_DIR}/tts',
+    max_bytes=int(os.getenv('TTS_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+)
+
+
+_project_indexes = {}
+_project_indexes_lock = threading.Lock()
+
+
+def get_project_index(project_dir: str=PROJECT_DIR) -> ProjectIndex:
+    """
+    Returns the index of the project files shared by every consumer of this process, refreshed on each call
+    (only changed files are reread) & persisted, so later processes start from it.
+    """
+    project_dir = os.path.abspath(project_dir)
+    index_path = _get_index_path(project_dir)
+    with _project_indexes_lock:
+        index = _project_indexes.get(project_dir)
+        if index is None:
+            index = _project_indexes[project_dir] = ProjectIndex.load(index_path, project_dir)
+    if index.refresh():
+        index.save(index_path)
+    return index
+
+
+def drop_project_index(project_dir: str) -> None:
+    """Forgets the index of a project dir that is deleted (e.g. batch jobs), in memory & on disk"""
+    project_dir = os.path.abspath(project_dir)
+    with _project_indexes_lock:
+        _project_indexes.pop(project_dir, None)
+        try:
+            os.remove(_get_index_path(project_dir))
+        except FileNotFoundError:
+            pass
+
+
+def _get_index_path(project_dir: str) -> str:
+    return f'{INDEX_DIR}/{DiskCache.make_key(project_dir)[:16]}.json'
+
+
+def get_cache_dir(
+    project_dir: str=PROJECT_DIR,
+    ignored_files: list[str]=None,
+    num: int=20,
+    user_instructions: str=''
+) -> str:
+    """
+    Returns the workspace of a project: same project content & same config give the same directory,
+    shared between runs and processes. Least recently used workspaces are deleted over WORKSPACES_MAX_BYTES.
+    """
+    columns, rows = get_project_index(project_dir).select(ignored_files or [])
+    # files over the hashing budget are identified by size & mtime
+    key = DiskCache.make_key(
+        [
+            (columns.paths[i], columns.hashes[i] or (columns.sizes[i], columns.mtimes[i]))
+            for i in rows
+        ],
+        sorted(ignored_files or []), num, user_instructions, LLM_BACKEND
+    )
+    cache_dir = f'{WORKSPACES_DIR}/{key[:16]}/'
+    os.makedirs(cache_dir, exist_ok=True)
+    # mark as recently used
+    os.utime(cache_dir)
+    deleted = collect_garbage(WORKSPACES_DIR, WORKSPACES_MAX_BYTES, keep=[cache_dir])
+    if deleted:
+        print(f'Deleted {len(deleted)} old workspaces')
+    return cache_dir
 
 
 def get_explanations(
@@ -30,91 +140,556 @@ def get_explanations(
     ignored_files: list[str]=None,
     user_instructions: str='',
     use_cache: bool=True,
+    cache_dir: str=None,
+    project_dir: str=PROJECT_DIR
+) -> list[dict]:
+    cache_dir = cache_dir or get_cache_dir(project_dir, ignored_files, num, user_instructions)
+    with lock_dir(cache_dir):
+        return _get_explanations(num, ignored_files, user_instructions, use_cache, cache_dir, project_dir)
+
+
+def _get_explanations(
+    num: int,
+    ignored_files: list[str],
+    user_instructions: str,
+    use_cache: bool,
+    cache_dir: str,
+    project_dir: str
 ) -> list[dict]:
     # generate explanations (or read cache)
-    if use_cache and os.path.exists(f'{CACHE_DIR}../explanations.json'):
-        with open(f'{CACHE_DIR}../explanations.json', 'r') as file:
+    if use_cache and os.path.exists(f'{cache_dir}explanations.json'):
+        with open(f'{cache_dir}explanations.json', 'r') as file:
             explanations = json.load(file)
     else:
-        explanations = explain_codebase(PROJECT_DIR, ignored_files, num, user_instructions)
-        explanations = add_highlighting(PROJECT_DIR, ignored_files=ignored_files, explanations=explanations)
-        with open(f'{CACHE_DIR}explanations.json', 'w') as file:
+        # the project is ingested once, both prompts are rendered from the same snapshot
+        snapshot = ingest_codebase(
+            project_dir, ignored_files=ignored_files, index=get_project_index(project_dir)
+        )
+        # identical prompts are answered from the llm cache
+        llm = get_llm(LLM_BACKEND, cache=LLM_CACHE if use_cache else None)
+        explanations = explain_codebase(
+            project_dir, ignored_files, num, user_instructions, snapshot=snapshot, llm=llm
+        )
+        explanations = add_highlighting(
+            project_dir, ignored_files=ignored_files, explanations=explanations, snapshot=snapshot, llm=llm
+        )
+        print(f'LLM stats: {LLM_STATS.to_dict()}')
+        with open(f'{cache_dir}explanations.json', 'w') as file:
             json.dump(explanations, file, indent=4)
     return explanations
 
 
+class GenerationCancelled(Exception):
+    """Raised by a video generation whose cancel event was set"""
+
+
+def _check_cancel(cancel: threading.Event | None) -> None:
+    if cancel is not None and cancel.is_set():
+        raise GenerationCancelled('Video generation cancelled')
+
+
+def _progress_counter(
+    progress: Callable[[dict], None] | None,
+    stage: str,
+    total: int
+) -> Callable[[str], None] | None:
+    """Callback counting the items done by a stage, reported to progress as {stage, done, total, item}"""
+    if progress is None:
+        return None
+    lock = threading.Lock()
+    done = 0
+
+    def on_done(item: str) -> None:
+        nonlocal done
+        # called from the event loop & from encoder threads
+        with lock:
+            done += 1
+            progress({'stage': stage, 'done': done, 'total': total, 'item': item})
+    progress({'stage': stage, 'done': 0, 'total': total, 'item': None})
+    return on_done
+
+
+def _is_cover(file_path: str) -> bool:
+    return file_path in ('', '.', None, '0')
+
+
+def _is_directory(file_path: str, project_dir: str) -> bool:
+    return file_path == './' or os.path.isdir(os.path.join(project_dir, os.path.normpath(file_path)))
+
+
+def _generate_image(
+    item: dict,
+    title: str,
+    subtitle: str,
+    project_dir: str,
+    cache_dir: str,
+    screenshot_backend: str=SCREENSHOT_BACKEND,
+    project_tree: str=None
+) -> Image.Image:
+    # if project idea
+    if _is_cover(item['file_path']):
+        return draw_project_cover(project_title=title, project_subtitle=subtitle, cache=SLIDE_CACHE)
+    # if directory
+    if _is_directory(item['file_path'], project_dir):
+        project_tree = project_tree or generate_codebase_tree(project_dir, get_project_index(project_dir))
+        return draw_project_tree(title, project_tree, cache=SLIDE_CACHE)
+    # if file
+    file_path = os.path.join(project_dir, item['file_path'])
+    with open(file_path, 'r') as f:
+        code = f.read()
+    start_line = item['start_line'] if item['start_line'] and item['start_line'] >= 2 else None
+    return create_screenshot(
+        code=code,
+        cache_dir=cache_dir,
+        file_rel_path=os.path.relpath(file_path, project_dir),
+        highlight_start=start_line,
+        highlight_num_lines=(item['end_line'] - start_line + 1) if start_line else None,
+        backend=screenshot_backend,
+        cache=SCREENSHOT_CACHE
+    )
+
+
+async def _render_slide(
+    name: str,
+    item: dict,
+    title: str,
+    subtitle: str,
+    project_dir: str,
+    cache_dir: str,
+    frame_store: FrameStore,
+    screenshot_backend: str=SCREENSHOT_BACKEND,
+    project_tree: str=None,
+    manifest: Manifest=None
+) -> str:
+    """Renders one slide into the frame store, a failing slide becomes a black frame (not recorded)"""
+    def generate_image() -> Image.Image:
+        with limit('render'), span('screenshot', slide=str(name), file=item['file_path']):
+            return _generate_image(item, title, subtitle, project_dir, cache_dir, screenshot_backend, project_tree)
+
+    try:
+        img = await asyncio.to_thread(generate_image)
+        failed = False
+    except Exception as e:
+        # a failing slide must not take the others down
+        print(f'file {item["file_path"]} failed to generate screenshot: {e}')
+        img = Image.new('RGB', (3524, 2068), color=(0, 0, 0))
+        failed = True
+    path = await asyncio.to_thread(frame_store.put, name, img)
+    if manifest is not None and not failed:
+        manifest.set('image', name, path)
+    print(f'Created screenshot for {name}.png')
+    return path
+
+
 async def _generate_images(
     explanations: list[dict],
     title: str,
     subtitle: str,
-    project_dir: str
-) -> list[np.ndarray]:
-    images = []
-    cover_image, dir_image = None, None
-    for i, item in enumerate(explanations):
-        if item['file_path'] == '' or item['file_path'] == '.' or item['file_path'] is None or item['file_path'] == '0':
-            img = await asyncio.to_thread(
-                draw_project_cover,
-                project_title=title, project_subtitle=subtitle
-            ) if not cover_image else cover_image
-        # if directory
-        elif item['file_path'] == './' or os.path.isdir(os.path.normpath(item['file_path'])):
-            img = await asyncio.to_thread(
-                draw_project_tree,
-                title, generate_codebase_tree(project_dir)
-            ) if not dir_image else dir_image
-        # if file
-        else:
-            item['file_path'] = os.path.join(PROJECT_DIR, item['file_path'])
-            item['code'] = open(item['file_path'], 'r').read()
-            if not item['start_line'] or item['start_line'] < 2:
-                item['start_line'] = None
-            try:
-                img = await asyncio.to_thread(
-                    create_screenshot,
-                    code=item['code'],
-                    cache_dir=CACHE_DIR,
-                    file_rel_path=os.path.relpath(item['file_path'], PROJECT_DIR),
-                    highlight_start=item['start_line'],
-                    highlight_num_lines=(item['end_line'] - item['start_line'] + 1) if item['start_line'] else None
-                )
-            except Exception as e:
-                print(f'file {item["file_path"]} failed to generate screenshot: {e}')
-                img = Image.new('RGB', (3524, 2068), color=(0, 0, 0))
-        images.append(np.array(img))
-        img.save(f'{CACHE_DIR}{i}.png')
-        print(f'Created screenshot for {i}.png')
+    project_dir: str,
+    cache_dir: str,
+    concurrency: int=SCREENSHOT_CONCURRENCY,
+    screenshot_backend: str=SCREENSHOT_BACKEND,
+    names: list[str]=None,
+    manifest: Manifest=None,
+    project_tree: str=None,
+    on_rendered: Callable[[str], None]=None,
+    cancel: threading.Event=None
+) -> list[str]:
+    """
+    Renders slides into the frame store, returns their paths (in the explanations order).
+    Slides are saved under names (default: their index), successful ones are recorded in the manifest.
+    on_rendered is called with each slide path once saved, no slide is started once cancel is set.
+    """
+    # render up to `concurrency` slides at once, slides are not kept in memory once saved
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    frame_store = FrameStore(f'{cache_dir}frames')
+    names = names or list(range(len(explanations)))
+    # the tree is walked once per run
+    if project_tree is None and any(
+        not _is_cover(item['file_path']) and _is_directory(item['file_path'], project_dir)
+        for item in explanations
+    ):
+        project_tree = generate_codebase_tree(project_dir, get_project_index(project_dir))
+
+    async def generate(name: str, item: dict) -> str:
+        async with semaphore:
+            _check_cancel(cancel)
+            path = await _render_slide(
+                name, item, title, subtitle, project_dir, cache_dir, frame_store,
+                screenshot_backend, project_tree, manifest
+            )
+        if on_rendered is not None:
+            on_rendered(path)
+        return path
+
+    images = list(await asyncio.gather(*(
+        generate(name, item) for name, item in zip(names, explanations)
+    )))
+    print(f'Screenshot cache: {SCREENSHOT_CACHE.stats()}')
     return images
 
 
+async def _synthesize_slide(
+    tts: SpeechTextConverter,
+    name: str,
+    item: dict,
+    audio_path: str=None
+) -> tuple:
+    def synthesize() -> tuple:
+        text = preprocess_text(item['explanatory_text'])
+        if audio_path is None:
+            return tts.str_to_audio(text)
+        # the slide audio is encoded sentence by sentence, while the next sentences are synthesized
+        with open_audio_encoder(audio_path, SAMPLE_RATE) as write_chunk:
+            return tts.str_to_audio(text, on_chunk=write_chunk)
+
+    sr, audio_np = await asyncio.to_thread(synthesize)
+    print(f'Created audio {name}')
+    return sr, audio_np
+
+
 async def _generate_audios(
     tts: SpeechTextConverter,
-    explanations: list[dict]
+    explanations: list[dict],
+    cache_dir: str,
+    names: list[str]=None,
+    on_synthesized: Callable[[str], None]=None,
+    cancel: threading.Event=None
 ) -> tuple:
-    audios = []
-    for i, item in enumerate(explanations):
-        # create audio
-        sr, audio_np = await asyncio.to_thread(
-            tts.str_to_audio,
-            preprocess_text(item['explanatory_text'])
-        )
-        audios.append(audio_np)
-        save_audio_to_file(audio_np, sr, f'{CACHE_DIR}{i}.mp3')
-        print(f'Created audio for {i}.mp3')
+    # as many texts in flight as the tts has workers, results keep the explanations order
+    semaphore = asyncio.Semaphore(tts.num_workers)
+    names = names or list(range(len(explanations)))
+
+    async def generate(name: str, item: dict) -> tuple:
+        async with semaphore:
+            _check_cancel(cancel)
+            result = await _synthesize_slide(tts, name, item)
+        if on_synthesized is not None:
+            on_synthesized(str(name))
+        return result
+
+    results = await asyncio.gather(*(
+        generate(name, item) for name, item in zip(names, explanations)
+    ))
+    audios = [audio_np for _, audio_np in results]
+    sr = results[0][0] if results else SAMPLE_RATE
     return audios, sr
 
 
+def _hash_file(file_path: str) -> str:
+    try:
+        with open(file_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+def _get_slide_keys(
+    item: dict,
+    tts: SpeechTextConverter,
+    title: str,
+    subtitle: str,
+    project_dir: str,
+    project_tree: str,
+    screenshot_backend: str
+) -> dict:
+    """Keys of a slide artifacts, each one changes only when the inputs of that artifact change"""
+    audio_key = DiskCache.make_key(
+        preprocess_text(item['explanatory_text']), tts.voice, tts.speed, tts.repo_id
+    )
+    if _is_cover(item['file_path']):
+        image_inputs = ('cover', title, subtitle)
+    elif _is_directory(item['file_path'], project_dir):
+        image_inputs = ('tree', title, project_tree)
+    else:
+        image_inputs = (
+            'file', item['file_path'], item['start_line'], item['end_line'],
+            _hash_file(os.path.join(project_dir, item['file_path'])), screenshot_backend
+        )
+    image_key = DiskCache.make_key(*image_inputs)
+    return {
+        'audio': audio_key,
+        'image': image_key,
+        'segment': DiskCache.make_key(audio_key, image_key),
+    }
+
+
+def _first_indices(keys: list[dict], kind: str, indices: list[int]=None) -> list[int]:
+    """Indices of the first slide of each distinct key, so identical artifacts are built once"""
+    indices = indices if indices is not None else list(range(len(keys)))
+    seen, first_indices = set(), []
+    for i, slide_keys in zip(indices, keys):
+        if slide_keys[kind] not in seen:
+            seen.add(slide_keys[kind])
+            first_indices.append(i)
+    return first_indices
+
+
 def generate_video(
     tts: SpeechTextConverter,
     explanations: list[dict],
     title: str,
-    subtitle: str
-):
-    """Generate video from explanations using the video pipeline"""
+    subtitle: str,
+    output_path: str,
+    screenshot_backend: str=SCREENSHOT_BACKEND,
+    video_encoder: str=VIDEO_ENCODER,
+    cache_dir: str=None,
+    project_dir: str=PROJECT_DIR,
+    progress: Callable[[dict], None]=None,
+    cancel: threading.Event=None
+) -> str:
+    """
+    Generate video from explanations using the video pipeline, saves it to output_path.
+    Artifacts are recorded in the workspace manifest, a regeneration only rebuilds the slides whose inputs changed.
+    progress receives an event per slide & stage (images, audios, segments, video), setting cancel stops
+    the generation between slides with GenerationCancelled (finished artifacts are kept for the next run).
+    """
+    cache_dir = cache_dir or get_cache_dir(project_dir)
+
+    async def generate():
+        manifest = Manifest(f'{cache_dir}manifest.json')
+        # artifacts built before a cancellation (or a failure) are kept for the next run
+        try:
+            project_tree = generate_codebase_tree(project_dir, get_project_index(project_dir))
+            keys = [
+                _get_slide_keys(item, tts, title, subtitle, project_dir, project_tree, screenshot_backend)
+                for item in explanations
+            ]
+            # slides to rebuild, with segments an unchanged slide is reused as a whole
+            if video_encoder == 'segments':
+                stale = _first_indices(keys, 'segment')
+                stale = [i for i in stale if not manifest.get('segment', keys[i]['segment'])]
+            else:
+                stale = list(range(len(explanations)))
+            missing_images = [
+                i for i in _first_indices([keys[i] for i in stale], 'image', stale)
+                if not manifest.get('image', keys[i]['image'])
+            ]
+            print(f'Rebuilding {len(stale)}/{len(explanations)} slides ({len(missing_images)} images)')
+            new_image_paths, (audios, sr) = await asyncio.gather(
+                _generate_images(
+                    [explanations[i] for i in missing_images], title, subtitle, project_dir, cache_dir,
+                    screenshot_backend=screenshot_backend,
+                    names=[keys[i]['image'] for i in missing_images],
+                    manifest=manifest,
+                    project_tree=project_tree,
+                    on_rendered=_progress_counter(progress, 'images', len(missing_images)),
+                    cancel=cancel
+                ),
+                _generate_audios(
+                    tts, [explanations[i] for i in stale], cache_dir,
+                    names=[keys[i]['audio'] for i in stale],
+                    on_synthesized=_progress_counter(progress, 'audios', len(stale)),
+                    cancel=cancel
+                ),
+            )
+            _check_cancel(cancel)
+            new_image_paths = {keys[i]['image']: path for i, path in zip(missing_images, new_image_paths)}
+            image_paths = [
+                new_image_paths.get(keys[i]['image']) or manifest.get('image', keys[i]['image'])
+                for i in stale
+            ]
+            if video_encoder == 'moviepy':
+                await asyncio.to_thread(save_video, merge_all(audios, image_paths, sr), output_path)
+            elif video_encoder == 'slideshow':
+                await asyncio.to_thread(encode_slideshow, image_paths, audios, sr, output_path)
+            else:
+                os.makedirs(f'{cache_dir}segments', exist_ok=True)
+                segment_paths = [f'{cache_dir}segments/{keys[i]["segment"]}.mp4' for i in stale]
+                encoded_paths = await asyncio.to_thread(
+                    encode_segments, image_paths, audios, sr, segment_paths, ENCODE_CONCURRENCY,
+                    _progress_counter(progress, 'segments', len(segment_paths)), cancel
+                )
+                for i, segment_path in zip(stale, encoded_paths):
+                    # slides whose image failed are not recorded, so they are rebuilt next time
+                    if segment_path and manifest.get('image', keys[i]['image']):
+                        manifest.set('segment', keys[i]['segment'], segment_path)
+                _check_cancel(cancel)
+                await asyncio.to_thread(
+                    concat_segments,
+                    [f'{cache_dir}segments/{slide_keys["segment"]}.mp4' for slide_keys in keys],
+                    output_path
+                )
+            if progress is not None:
+                progress({'stage': 'video', 'done': 1, 'total': 1, 'item': output_path})
+            return output_path
+        finally:
+            manifest.save()
+    # concurrent runs on the same workspace wait for each other, then reuse its artifacts
+    with lock_dir(cache_dir), span('video', encoder=video_encoder, slides=len(explanations)):
+        return asyncio.run(generate())
+
+
+def generate_video_streaming(
+    tts: SpeechTextConverter,
+    title: str,
+    subtitle: str,
+    output_path: str,
+    num: int=20,
+    ignored_files: list[str]=None,
+    user_instructions: str='',
+    use_cache: bool=True,
+    screenshot_backend: str=SCREENSHOT_BACKEND,
+    video_encoder: str=VIDEO_ENCODER,
+    cache_dir: str=None,
+    project_dir: str=PROJECT_DIR
+) -> str:
+    """
+    Explains the project & generates its video in one go, saves it to output_path.
+    Explanations are consumed while the llm streams them: the screenshot & audio of a slide
+    (and its segment) are built as soon as its explanation arrives, while later ones are still generated.
+    """
+    cache_dir = cache_dir or get_cache_dir(project_dir, ignored_files, num, user_instructions)
+
     async def generate():
-        images, (audios, sr) = await asyncio.gather(
-            _generate_images(explanations, title, subtitle, PROJECT_DIR),
-            _generate_audios(tts, explanations),
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        index = await asyncio.to_thread(get_project_index, project_dir)
+        snapshot = await asyncio.to_thread(ingest_codebase, project_dir, ignored_files, index=index)
+        llm = get_llm(LLM_BACKEND, cache=LLM_CACHE if use_cache else None)
+
+        def produce() -> None:
+            # runs in a thread, hands explanations over to the event loop one by one
+            try:
+                for item in stream_explanations(
+                    project_dir, ignored_files, num, user_instructions, snapshot=snapshot, llm=llm
+                ):
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        producer = asyncio.create_task(asyncio.to_thread(produce))
+        manifest = Manifest(f'{cache_dir}manifest.json')
+        frame_store = FrameStore(f'{cache_dir}frames')
+        project_tree = generate_codebase_tree(project_dir, index)
+        screenshot_semaphore = asyncio.Semaphore(max(1, SCREENSHOT_CONCURRENCY))
+        audio_semaphore = asyncio.Semaphore(tts.num_workers)
+        encode_semaphore = asyncio.Semaphore(max(1, ENCODE_CONCURRENCY))
+        # share the cores between concurrent encoders
+        encode_threads = max(1, (os.cpu_count() or 1) // max(1, ENCODE_CONCURRENCY))
+        os.makedirs(f'{cache_dir}segments', exist_ok=True)
+
+        async def render(item: dict, image_key: str) -> str:
+            path = manifest.get('image', image_key)
+            if path:
+                return path
+            async with screenshot_semaphore:
+                return await _render_slide(
+                    image_key, item, title, subtitle, project_dir, cache_dir, frame_store,
+                    screenshot_backend, project_tree, manifest
+                )
+
+        async def synthesize(item: dict, audio_key: str, audio_path: str=None) -> tuple:
+            async with audio_semaphore:
+                return await _synthesize_slide(tts, audio_key, item, audio_path)
+
+        async def encode(item: dict, slide_keys: dict) -> str:
+            segment_path = f'{cache_dir}segments/{slide_keys["segment"]}.mp4'
+            if manifest.get('segment', slide_keys['segment']):
+                return segment_path
+            # the audio track is encoded while synthesized, the segment encode only copies it
+            audio_path = f'{cache_dir}segments/{slide_keys["segment"]}.m4a'
+            image_path, (sr, audio_np) = await asyncio.gather(
+                images[slide_keys['image']], synthesize(item, slide_keys['audio'], audio_path)
+            )
+            try:
+                async with encode_semaphore:
+                    await asyncio.to_thread(
+                        encode_slideshow, [image_path], [audio_np], sr, segment_path,
+                        threads=encode_threads, encoded_audio=audio_path
+                    )
+            finally:
+                os.remove(audio_path)
+            # slides whose image failed are not recorded, so they are rebuilt next time
+            if manifest.get('image', slide_keys['image']):
+                manifest.set('segment', slide_keys['segment'], segment_path)
+            print(f'Encoded segment {slide_keys["segment"]}.mp4')
+            return segment_path
+
+        explanations, keys = [], []
+        # tasks by key, identical slides are built once
+        images, segments, audios = {}, {}, []
+        while (item := await queue.get()) is not None:
+            explanations.append(item)
+            slide_keys = _get_slide_keys(
+                item, tts, title, subtitle, project_dir, project_tree, screenshot_backend
+            )
+            keys.append(slide_keys)
+            if slide_keys['image'] not in images:
+                images[slide_keys['image']] = asyncio.create_task(render(item, slide_keys['image']))
+            if video_encoder == 'segments':
+                if slide_keys['segment'] not in segments:
+                    segments[slide_keys['segment']] = asyncio.create_task(encode(item, slide_keys))
+            else:
+                audios.append(asyncio.create_task(synthesize(item, slide_keys['audio'])))
+            print(f'Explanation {len(explanations)} received: {item["file_path"]}')
+        await producer
+        print(f'LLM stats: {LLM_STATS.to_dict()}')
+        if not explanations:
+            raise ValueError('No explanations were generated')
+        with open(f'{cache_dir}explanations.json', 'w') as file:
+            json.dump(explanations, file, indent=4)
+        if video_encoder == 'segments':
+            segment_paths = [await segments[slide_keys['segment']] for slide_keys in keys]
+            await asyncio.to_thread(concat_segments, segment_paths, output_path)
+        else:
+            image_paths = [await images[slide_keys['image']] for slide_keys in keys]
+            results = await asyncio.gather(*audios)
+            audio_arrays, sr = [audio_np for _, audio_np in results], results[0][0]
+            if video_encoder == 'moviepy':
+                await asyncio.to_thread(save_video, merge_all(audio_arrays, image_paths, sr), output_path)
+            else:
+                await asyncio.to_thread(encode_slideshow, image_paths, audio_arrays, sr, output_path)
+        print(f'Screenshot cache: {SCREENSHOT_CACHE.stats()}')
+        manifest.save()
+        return output_path
+    with lock_dir(cache_dir), span('video', encoder=video_encoder, streaming=True):
+        return asyncio.run(generate())
+
+
+class VideoJob:
+    """
+    generate_video running in a background thread, so the caller (the app) stays responsive.
+    Keeps the last progress event of each stage & the result, both read from other threads.
+    """
+    def __init__(self, tts: SpeechTextConverter, explanations: list[dict], title: str, subtitle: str,
+                 output_path: str, **kwargs) -> None:
+        self.output_path = output_path
+        self.status = 'running'
+        self.error = None
+        self.progress = {}
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(tts, explanations, title, subtitle, output_path),
+            kwargs=kwargs,
+            daemon=True
         )
-        return merge_all(audios, images, sr)
-    return asyncio.run(generate())
+        self._thread.start()
+
+    def _on_progress(self, event: dict) -> None:
+        with self._lock:
+            self.progress[event['stage']] = event
+
+    def _run(self, *args, **kwargs) -> None:
+        try:
+            generate_video(*args, progress=self._on_progress, cancel=self.cancel_event, **kwargs)
+            status = 'done'
+        except GenerationCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            print(f'Video generation failed: {e}')
+            self.error = f'{type(e).__name__}: {e}'
+            status = 'failed'
+        with self._lock:
+            self.status = status
+
+    def cancel(self) -> None:
+        """Stops the generation at the next slide, see generate_video"""
+        self.cancel_event.set()
+
+    def snapshot(self) -> tuple[str, dict]:
+        """Status & last progress event per stage"""
+        with self._lock:
+            return self.status, dict(self.progress)
@@ -1,19 +1,90 @@
 import os
 import re
 import shutil
+import time
 import base64
+import secrets
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from git import Repo
+from utils.explainer.codebase_parser import list_files
+from utils.media_server import MEDIA_URL
 from core import (
     PROJECT_DIR,
-    STATIC_DIR
+    STATIC_DIR,
+    curr_dir,
+    get_project_index
 )
 
 
-def copy_local_folder(folder_dir):
-    """Copy a local project folder into the project directory"""
+# how github repos are cloned: 'shallow' (last commit of the default branch),
+# 'partial' (whole history, file contents fetched only for the checkout) or 'full'
+CLONE_MODE = os.getenv('CLONE_MODE', 'shallow')
+CLONE_OPTIONS = {
+    'shallow': dict(depth=1, single_branch=True, no_tags=True),
+    'partial': dict(multi_options=['--filter=blob:none']),
+    'full': dict(),
+}
+# how local folders are copied: 'reflink' (copy-on-write clone, falls back to copy),
+# 'hardlink' (files shared with the source, falls back to copy) or 'copy'
+COPY_MODE = os.getenv('COPY_MODE', 'reflink')
+COPY_WORKERS = 8
+# linux ioctl cloning a file into another one (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# generated videos are served by the media server from here (streamed, never held in memory)
+PUBLISHED_VIDEOS_DIR = f'{curr_dir}/temp/videos'
+# published videos older than this are deleted
+PUBLISHED_VIDEOS_TTL = 24 * 3600
+
+
+def reflink_file(src, dst):
+    """Clones src into dst sharing its blocks, raises OSError when the filesystem cannot"""
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, mode=COPY_MODE):
+    """Copies a file with the given mode, returns the mode actually used"""
+    if mode in ('reflink', 'hardlink'):
+        try:
+            if mode == 'reflink':
+                reflink_file(src, dst)
+            else:
+                os.link(src, dst)
+            return mode
+        except (ImportError, OSError):
+            # not supported here (filesystem, other device, os)
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def copy_local_folder(folder_dir, mode=COPY_MODE, project_dir=PROJECT_DIR):
+    """
+    Copy a local project folder into the (emptied) project directory,
+    folders ignored by the parser & .gitignore matches are skipped while copying
+    """
     try:
-        shutil.copytree(folder_dir, PROJECT_DIR, dirs_exist_ok=True)
+        if os.path.exists(project_dir):
+            shutil.rmtree(project_dir)
+        file_paths = list_files(folder_dir, ignored_files=[])
+        os.makedirs(project_dir, exist_ok=True)
+        for dir_path in {os.path.dirname(os.path.relpath(path, folder_dir)) for path in file_paths}:
+            os.makedirs(os.path.join(project_dir, dir_path), exist_ok=True)
+
+        def copy(src):
+            dst = os.path.join(project_dir, os.path.relpath(src, folder_dir))
+            try:
+                return copy_file(src, dst, mode)
+            except OSError as e:
+                print(f"Error copying {src}: {e}")
+
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+            used_modes = list(executor.map(copy, file_paths))
+        print(f"Copied {len(file_paths)} files into project directory ({mode}: {used_modes.count(mode)})")
     except Exception as e:
         print(f"Error copying folder {folder_dir} into project directory: {e}")
 
@@ -33,15 +104,19 @@ def is_valid_github_repo_url(url):
         return False
 
 
-def clone_github_repo(repo_url):
-    """Clone a github repo into the project directory"""
+def clone_github_repo(repo_url, mode=CLONE_MODE, project_dir=PROJECT_DIR):
+    """Clone a github repo into the project directory, mode is one of CLONE_OPTIONS"""
     try:
-        if os.path.exists(PROJECT_DIR):
-            # raise Exception(f"The destination path '{PROJECT_DIR}' already exists.")
-            shutil.rmtree(PROJECT_DIR)
-            print(f"Deleted existing project directory: {PROJECT_DIR}")
-        Repo.clone_from(repo_url, PROJECT_DIR, allow_unsafe_options=True, allow_unsafe_protocols=True)
-        return PROJECT_DIR
+        if os.path.exists(project_dir):
+            # raise Exception(f"The destination path '{project_dir}' already exists.")
+            shutil.rmtree(project_dir)
+            print(f"Deleted existing project directory: {project_dir}")
+        Repo.clone_from(
+            repo_url, project_dir,
+            allow_unsafe_options=True, allow_unsafe_protocols=True,
+            **CLONE_OPTIONS[mode]
+        )
+        return project_dir
     except Exception as e:
         raise Exception(f"Failed to clone repository: {e}")
 
@@ -59,22 +134,25 @@ def read_logo_image() -> str:
     return logo_b64
 
 
+def publish_video(video_path: str) -> str:
+    """
+    Copies the video into the media server dir under an unguessable name & returns its url,
+    videos published more than PUBLISHED_VIDEOS_TTL ago are removed
+    """
+    os.makedirs(PUBLISHED_VIDEOS_DIR, exist_ok=True)
+    for entry in os.scandir(PUBLISHED_VIDEOS_DIR):
+        try:
+            if entry.stat().st_mtime < time.time() - PUBLISHED_VIDEOS_TTL:
+                os.remove(entry.path)
+        except OSError:
+            continue
+    name = f'{secrets.token_hex(16)}.mp4'
+    # not a hardlink: a later run of the same workspace rewrites its video in place
+    copy_file(video_path, f'{PUBLISHED_VIDEOS_DIR}/{name}', mode='reflink')
+    os.utime(f'{PUBLISHED_VIDEOS_DIR}/{name}')
+    return f'{MEDIA_URL}/{name}'
+
+
 def get_files_types() -> list[str]:
     """Gets unique file types in the given project"""
-    folders_to_ignore = [
-        'node_modules', '.git',
-        'venv', '.venv', '__pycache__',
-        '.pytest_cache', '.vscode',
-        'build', 'dist', '.mypy_cache',
-        '.ipynb_checkpoints',
-    ]
-    extensions = set()
-    for root, folders, files in os.walk(PROJECT_DIR):
-        for ignored_folder in folders_to_ignore:
-            if ignored_folder in folders:
-                folders.remove(ignored_folder)
-        for file in files:
-            if '.' in file:
-                ext = file.split('.')[-1]
-                extensions.add(ext)
-    return list(extensions)
+    return get_project_index(PROJECT_DIR).get_extensions()
@@ -1,22 +1,273 @@
-from utils.video_utils import save_video
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from utils.tts import SpeechTextConverter
+from utils.cache import FileLock
+from utils.limits import RESOURCE_LIMITS
+from utils.profiling import PROFILER, start_metrics_server
 from core import (
-    get_explanations,
-    generate_video,
-    CACHE_DIR
+    generate_video_streaming,
+    get_cache_dir,
+    drop_project_index,
+    curr_dir,
+    TTS_CACHE,
+    TTS_WORKERS,
+    TTS_TORCH_THREADS
 )
 
 
+# batch jobs acquire their projects here, one dir per job (deleted once the job is over)
+BATCH_PROJECTS_DIR = f'{curr_dir}/temp/projects'
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    """
+    Persistent queue of video jobs (a json file), shared by every process working on it.
+    A job is pending, running, done or failed; failed jobs are retried up to max_attempts,
+    running jobs whose process died (on this host) are given back to the queue.
+    """
+    def __init__(self, path: str, max_attempts: int=2) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, jobs: dict) -> None:
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(jobs, f, indent=4)
+        os.replace(temp_path, self.path)
+
+    def _update(self, change) -> object:
+        """Read-modify-write of the queue file, under a lock held by one thread of one process"""
+        with self._lock, FileLock(f'{self.path}.lock'):
+            jobs = self._load()
+            result = change(jobs)
+            self._save(jobs)
+            return result
+
+    def add(self, specs: list[dict]) -> list[str]:
+        """Adds jobs (ids default to a hash of the spec), jobs already queued keep their state"""
+        def add(jobs: dict) -> list[str]:
+            ids = []
+            for spec in specs:
+                job_id = spec.get('id') or hashlib.sha256(
+                    json.dumps(spec, sort_keys=True).encode('utf-8')
+                ).hexdigest()[:12]
+                jobs.setdefault(job_id, {'spec': spec, 'status': 'pending', 'attempts': 0, 'error': None})
+                ids.append(job_id)
+            return ids
+        return self._update(add)
+
+    def recover(self) -> int:
+        """Gives back the running jobs of dead processes of this host, returns their number"""
+        host = socket.gethostname()
+
+        def recover(jobs: dict) -> int:
+            recovered = 0
+            for job in jobs.values():
+                if job['status'] != 'running':
+                    continue
+                worker_host, _, pid = job.get('worker', '').rpartition(':')
+                if worker_host == host and not _is_alive(int(pid or 0)):
+                    job['status'] = 'pending'
+                    recovered += 1
+            return recovered
+        return self._update(recover)
+
+    def claim(self) -> tuple[str, dict] | None:
+        """Marks the next pending (or retryable failed) job as running by this process"""
+        def claim(jobs: dict) -> tuple[str, dict] | None:
+            for job_id, job in jobs.items():
+                retryable = job['status'] == 'failed' and job['attempts'] < self.max_attempts
+                if job['status'] == 'pending' or retryable:
+                    job.update(status='running', worker=WORKER_ID, started_at=time.time())
+                    job['attempts'] += 1
+                    return job_id, job['spec']
+            return None
+        return self._update(claim)
+
+    def finish(self, job_id: str, error: str=None, output: str=None) -> None:
+        def finish(jobs: dict) -> None:
+            job = jobs[job_id]
+            job.update(status='failed' if error else 'done', error=error, output=output, finished_at=time.time())
+        self._update(finish)
+
+    def counts(self) -> dict:
+        counts = {}
+        for job in self._load().values():
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+
+def _is_alive(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # exists but belongs to someone else
+        return True
+    return True
+
+
+def read_batch_manifest(path: str) -> list[dict]:
+    """
+    A manifest is a json list of jobs (or {"jobs": [...]}), each with a "source" (github url or local folder),
+    "title", "output" and optional "subtitle", "num", "ignored_files" (extensions), "user_instructions", "voice_speed", "id"
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    specs = data['jobs'] if isinstance(data, dict) else data
+    for spec in specs:
+        missing = [key for key in ('source', 'title', 'output') if not spec.get(key)]
+        if missing:
+            raise ValueError(f"Job {spec} is missing {', '.join(missing)}")
+    return specs
+
+
+def acquire_project(source: str, project_dir: str) -> None:
+    # imported here, git is only needed for batch & the app
+    from helper import copy_local_folder, clone_github_repo
+    if source.startswith(('https://', 'http://', 'git@')):
+        clone_github_repo(source, project_dir=project_dir)
+    elif os.path.isdir(source):
+        copy_local_folder(source, project_dir=project_dir)
+    else:
+        raise ValueError(f'Source {source} is neither a repo url nor a local folder')
+
+
+def run_job(job_id: str, spec: dict, get_tts) -> str:
+    project_dir = f'{BATCH_PROJECTS_DIR}/{job_id}'
+    try:
+        acquire_project(spec['source'], project_dir)
+        num = int(spec.get('num', 20))
+        ignored_files = spec.get('ignored_files', [])
+        user_instructions = spec.get('user_instructions', '')
+        cache_dir = get_cache_dir(project_dir, ignored_files, num, user_instructions)
+        output_path = os.path.abspath(spec['output'])
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return generate_video_streaming(
+            get_tts(float(spec.get('voice_speed', 1.0))),
+            spec['title'],
+            spec.get('subtitle', ''),
+            output_path,
+            num=num,
+            ignored_files=ignored_files,
+            user_instructions=user_instructions,
+            cache_dir=cache_dir,
+            project_dir=project_dir
+        )
+    finally:
+        shutil.rmtree(project_dir, ignore_errors=True)
+        drop_project_index(project_dir)
+
+
+def run_batch(queue: JobQueue, num_jobs: int=1) -> dict:
+    """Runs queued jobs, num_jobs at a time, until the queue has none left for this process"""
+    recovered = queue.recover()
+    if recovered:
+        print(f'Resuming {recovered} interrupted jobs')
+    # one tts per voice speed, shared by all jobs (its use is bounded by the tts limit)
+    tts_by_speed, tts_lock = {}, threading.Lock()
+
+    def get_tts(speed: float) -> SpeechTextConverter:
+        with tts_lock:
+            if speed not in tts_by_speed:
+                tts_by_speed[speed] = SpeechTextConverter(
+                    speed=speed,
+                    cache=TTS_CACHE,
+                    num_workers=TTS_WORKERS,
+                    torch_threads=TTS_TORCH_THREADS
+                )
+            return tts_by_speed[speed]
+
+    def work() -> None:
+        while (claimed := queue.claim()) is not None:
+            job_id, spec = claimed
+            print(f'Job {job_id} started: {spec["title"]} ({spec["source"]})')
+            try:
+                output_path = run_job(job_id, spec, get_tts)
+            except Exception as e:
+                traceback.print_exc()
+                queue.finish(job_id, error=f'{type(e).__name__}: {e}')
+                print(f'Job {job_id} failed: {e}')
+            else:
+                queue.finish(job_id, output=output_path)
+                print(f'Job {job_id} done: {output_path}')
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, num_jobs)) as executor:
+            for future in [executor.submit(work) for _ in range(max(1, num_jobs))]:
+                future.result()
+    finally:
+        for tts in tts_by_speed.values():
+            tts.close()
+    return queue.counts()
+
+
 def main() -> None:
+    start_metrics_server()
     title = input("Enter project title: ")
     subtitle = input("Enter project subtitle: ")
-    tts = SpeechTextConverter()
-    explanations = get_explanations(title)
-    # generate video
-    final_video = generate_video(tts, explanations, title, subtitle)
-    # save video
-    save_video(final_video, f'{CACHE_DIR}{title}.mp4')
+    tts = SpeechTextConverter(
+        cache=TTS_CACHE,
+        num_workers=TTS_WORKERS,
+        torch_threads=TTS_TORCH_THREADS
+    )
+    # generate explanations & video at once, slides are built while explanations stream in
+    cache_dir = get_cache_dir()
+    generate_video_streaming(tts, title, subtitle, f'{cache_dir}{title}.mp4', cache_dir=cache_dir)
+    tts.close()
+    print(f'Stages: {PROFILER.summary()}')
+
+
+def batch_main(args: list[str]=None) -> None:
+    parser = argparse.ArgumentParser(description='Generate videos for many projects, without interaction')
+    parser.add_argument('manifest', nargs='?', help='json list of jobs, added to the queue')
+    parser.add_argument('--queue', default='jobs.json', help='persistent job queue, resumed on restart')
+    parser.add_argument('--jobs', type=int, default=2, help='number of videos generated at the same time')
+    parser.add_argument('--max-attempts', type=int, default=2)
+    # unset limits keep their MAX_* env value
+    parser.add_argument('--max-llm', type=int, help='max concurrent llm calls (all jobs)')
+    parser.add_argument('--max-tts', type=int, help='max concurrent syntheses (all jobs)')
+    parser.add_argument('--max-render', type=int, help='max concurrent slide renders (all jobs)')
+    parser.add_argument('--max-encode', type=int, help='max concurrent segment encodes (all jobs)')
+    args = parser.parse_args(args)
+    for name in ('llm', 'tts', 'render', 'encode'):
+        max_concurrency = getattr(args, f'max_{name}')
+        if max_concurrency is not None:
+            RESOURCE_LIMITS.set_limit(name, max_concurrency)
+    start_metrics_server()
+    queue = JobQueue(args.queue, max_attempts=args.max_attempts)
+    if args.manifest:
+        print(f'Queued {len(queue.add(read_batch_manifest(args.manifest)))} jobs into {args.queue}')
+    counts = run_batch(queue, args.jobs)
+    print(f'Jobs: {counts}')
+    print(f'Stages: {PROFILER.summary()}')
+    if counts.get('failed'):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+    else:
+        main()
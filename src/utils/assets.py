@@ -0,0 +1,87 @@
+import os
+import argparse
+import requests
+
+
+"""
+This module is responsible for the local asset store (fonts & model weights),
+so rendering & synthesis do not need the network once assets are prefetched.
+"""
+
+
+ASSETS_DIR = os.getenv(
+    'CEVAIG_ASSETS_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets')
+)
+FONTS_DIR = os.path.join(ASSETS_DIR, 'fonts')
+MODELS_DIR = os.path.join(ASSETS_DIR, 'models')
+# strict offline mode: never touch the network, missing assets are errors
+OFFLINE = os.getenv('CEVAIG_OFFLINE', '0').lower() in ('1', 'true', 'yes')
+FONTS_BASE_URL = 'https://github.com/google/fonts/raw/refs/heads/main/ofl'
+FONTS = ('Space Mono', 'Solway', 'Fira Code')
+MODEL_REPO_ID = 'hexgrad/Kokoro-82M'
+MODEL_FILES = ('config.json', 'kokoro-v1_0.pth')
+VOICES = ('af_heart',)
+SPACY_MODEL = 'en_core_web_sm'
+
+# huggingface hub reads these when imported, so this module is imported before kokoro
+os.environ.setdefault('HF_HUB_CACHE', MODELS_DIR)
+if OFFLINE:
+    os.environ['HF_HUB_OFFLINE'] = '1'
+
+
+def get_font_file_names(font_name: str) -> list[str]:
+    # google fonts names static fonts 'Name-Regular.ttf' & variable fonts 'Name[wght].ttf'
+    name = font_name.replace(' ', '')
+    return [f'{name}-Regular.ttf', f'{name}[wght].ttf']
+
+
+def get_font_path(font_name: str) -> str:
+    """Returns the local file of a google font, downloading it into the store if needed"""
+    for file_name in get_font_file_names(font_name):
+        path = os.path.join(FONTS_DIR, file_name)
+        if os.path.exists(path):
+            return path
+    if OFFLINE:
+        raise ValueError(f"Font {font_name} is not in the asset store ({FONTS_DIR}) and offline mode is on")
+    folder_name = font_name.lower().replace(' ', '')
+    for file_name in get_font_file_names(font_name):
+        response = requests.get(f'{FONTS_BASE_URL}/{folder_name}/{file_name}', timeout=30)
+        if response.status_code == 200:
+            path = os.path.join(FONTS_DIR, file_name)
+            os.makedirs(FONTS_DIR, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(temp_path, path)
+            return path
+    raise ValueError(f"Could not load font: {font_name}")
+
+
+def prefetch_fonts(fonts: tuple=FONTS) -> None:
+    for font_name in fonts:
+        print(f'Font {font_name}: {get_font_path(font_name)}')
+
+
+def prefetch_model(repo_id: str=MODEL_REPO_ID, voices: tuple=VOICES) -> None:
+    """Downloads kokoro weights & voices into the store, along with the spacy model used by its g2p"""
+    from huggingface_hub import hf_hub_download
+    for file_name in MODEL_FILES + tuple(f'voices/{voice}.pt' for voice in voices):
+        print(f'Model {repo_id}/{file_name}: {hf_hub_download(repo_id, file_name, cache_dir=MODELS_DIR)}')
+    import spacy
+    if not spacy.util.is_package(SPACY_MODEL):
+        spacy.cli.download(SPACY_MODEL)
+    print(f'Spacy model {SPACY_MODEL}: installed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prefetch fonts & model weights into the local asset store')
+    parser.add_argument('--skip-fonts', action='store_true')
+    parser.add_argument('--skip-model', action='store_true')
+    args = parser.parse_args()
+    if OFFLINE:
+        raise SystemExit('Prefetching needs the network, unset CEVAIG_OFFLINE')
+    if not args.skip_fonts:
+        prefetch_fonts()
+    if not args.skip_model:
+        prefetch_model()
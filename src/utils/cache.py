@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from typing import Callable, Iterator
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+
+"""
+This module is responsible for persistent on-disk caches (content-addressed files with a size cap)
+and for the workspaces shared between runs & processes (locked, garbage collected)
+"""
+
+
+class DiskCache:
+    """
+    Stores one file per key inside cache_dir.
+    Least recently used files are evicted once the total size goes over max_bytes.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int=1024 ** 3) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Hashes any json-serializable parts into a cache key"""
+        data = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, key: str, suffix: str='') -> str:
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def get(self, key: str, suffix: str='') -> str | None:
+        """Returns the path of the cached file (marking it as recently used) or None"""
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key: str, writer: Callable[[str], None], suffix: str='') -> str:
+        """Calls writer with a temp path, then moves the written file into the cache atomically"""
+        with self.writing(key, suffix) as temp_path:
+            writer(temp_path)
+        return self.path(key, suffix)
+
+    @contextmanager
+    def writing(self, key: str, suffix: str='') -> Iterator[str]:
+        """
+        Yields a temp path to write the file of key, moved into the cache once the block succeeds
+        (so a file can be written while it is produced, readers never see it half written).
+        """
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            yield temp_path
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+            if self._size is None or self._size > self.max_bytes:
+                self._evict()
+
+    def _list_files(self) -> list[tuple[str, os.stat_result]]:
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    files.append((path, os.stat(path)))
+                except OSError:
+                    continue
+        return files
+
+    def _evict(self) -> None:
+        # rescan, other processes may share the same directory
+        files = self._list_files()
+        self._size = sum(stat.st_size for _, stat in files)
+        if self._size <= self.max_bytes:
+            return
+        for path, stat in sorted(files, key=lambda item: item[1].st_mtime):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= stat.st_size
+            if self._size <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': self._size}
+
+
+class Manifest:
+    """
+    Records which artifact file was built from which inputs (key), per kind of artifact.
+    Paths are stored relative to the manifest directory.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, kind: str, key: str) -> str | None:
+        """Returns the artifact built from key, None if it is stale or was deleted"""
+        with self._lock:
+            rel_path = self.entries.get(kind, {}).get(key)
+        if rel_path is None:
+            return None
+        path = os.path.join(self.root, rel_path)
+        return path if os.path.exists(path) else None
+
+    def set(self, kind: str, key: str, path: str) -> None:
+        with self._lock:
+            self.entries.setdefault(kind, {})[key] = os.path.relpath(os.path.abspath(path), self.root)
+
+    def save(self) -> None:
+        with self._lock:
+            data = json.dumps(self.entries, indent=4)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+
+class FileLock:
+    """Exclusive lock on a file, held by one process at a time (threads must not share one FileLock)"""
+    def __init__(self, path: str, blocking: bool=True) -> None:
+        self.path = path
+        self.blocking = blocking
+        self._file = None
+
+    def acquire(self) -> bool:
+        """Returns False when the lock is held by someone else and blocking is off"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._file = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | (0 if self.blocking else fcntl.LOCK_NB))
+            else:
+                self._file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not self.blocking:
+                            raise
+                        time.sleep(0.1)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self) -> None:
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> 'FileLock':
+        if not self.acquire():
+            raise TimeoutError(f'{self.path} is locked')
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def lock_dir(dir_path: str, blocking: bool=True) -> FileLock:
+    # the lock file lives next to the directory, so the directory can be deleted while locked
+    return FileLock(f'{os.path.normpath(dir_path)}.lock', blocking=blocking)
+
+
+def get_dir_size(dir_path: str) -> int:
+    size = 0
+    for root, _, names in os.walk(dir_path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return size
+
+
+def collect_garbage(root: str, max_bytes: int, keep: list[str]=()) -> list[str]:
+    """
+    Deletes the least recently used directories of root (by mtime) until their total size fits max_bytes.
+    Directories in keep or locked by another process are never deleted. Returns the deleted directories.
+    """
+    keep = {os.path.normpath(path) for path in keep}
+    dirs = []
+    for entry in os.scandir(root) if os.path.isdir(root) else []:
+        if entry.is_dir(follow_symlinks=False):
+            dirs.append((entry.path, entry.stat().st_mtime, get_dir_size(entry.path)))
+    total_size = sum(size for _, _, size in dirs)
+    deleted = []
+    for path, _, size in sorted(dirs, key=lambda item: item[1]):
+        if total_size <= max_bytes:
+            break
+        if os.path.normpath(path) in keep:
+            continue
+        lock = lock_dir(path, blocking=False)
+        if not lock.acquire():
+            continue
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            lock.release()
+        # lock files are kept, deleting them could let two processes lock the same workspace
+        total_size -= size
+        deleted.append(path)
+    return deleted
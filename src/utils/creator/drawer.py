@@ -1,7 +1,10 @@
 import random
-import requests
-from io import BytesIO
+import numpy as np
+from typing import Callable
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
+from utils.cache import DiskCache
+from utils.assets import get_font_path
 
 
 """
@@ -9,25 +12,48 @@ This module is responsible for drawing images using pillow.
 """
 
 
+@lru_cache(maxsize=64)
 def load_font(font_name: str, font_size: int) -> ImageFont.FreeTypeFont:
-    base_url = 'https://github.com/google/fonts/raw/refs/heads/main/ofl'
-    folder_name = font_name.lower().replace(' ', '')
-    file_name = font_name.replace(' ', '') + '-Regular.ttf'
-    font_url = f'{base_url}/{folder_name}/{file_name}'
-    response = requests.get(font_url)
-    
-    if response.status_code != 200:
-        # try another file name
-        file_name = font_name.replace(' ', '') + '[wght].ttf'
-        font_url = f'{base_url}/{folder_name}/{file_name}'
-        response = requests.get(font_url)
-    if response.status_code == 200:
-        return ImageFont.truetype(BytesIO(response.content), font_size)
-    else:
-        raise ValueError(f"Could not load font: {font_name}")
+    # fonts come from the local asset store, loaded once per (font, size)
+    return ImageFont.truetype(get_font_path(font_name), font_size)
+
+
+def get_cached_image(cache: DiskCache, key: str, draw: Callable[[], Image.Image]) -> Image.Image:
+    """Returns the image stored under key, draws & stores it when missing"""
+    if cache is None:
+        return draw()
+    cached_path = cache.get(key, suffix='.png')
+    if cached_path:
+        with Image.open(cached_path) as image:
+            return image.convert('RGB')
+    image = draw()
+    cache.put(key, lambda path: image.save(path, format='PNG'), suffix='.png')
+    return image
+
+
+def draw_gradient(start_color: tuple, end_color: tuple, width: int, height: int) -> Image.Image:
+    # horizontal gradient, computed for one row then repeated over all rows
+    x = np.arange(width)[:, None]
+    start, end = np.array(start_color), np.array(end_color)
+    row = (start + (end - start) * x // width).astype(np.uint8)
+    return Image.fromarray(np.ascontiguousarray(np.broadcast_to(row, (height, width, 3))), 'RGB')
 
 
 def draw_project_cover(
+    project_title: str,
+    project_subtitle: str,
+    width: int=3524,
+    height: int=2068,
+    font_size: int=300,
+    cache: DiskCache=None
+) -> Image.Image:
+    key = DiskCache.make_key('cover', project_title, project_subtitle, width, height, font_size)
+    return get_cached_image(cache, key, lambda: _draw_project_cover(
+        project_title, project_subtitle, width, height, font_size
+    ))
+
+
+def _draw_project_cover(
     project_title: str,
     project_subtitle: str,
     width: int=3524,
@@ -41,14 +67,9 @@ def draw_project_cover(
     # Generate random gradient colors
     start_color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
     end_color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-    image = Image.new('RGB', (width, height), color=start_color)
-    draw = ImageDraw.Draw(image)
     # generate gradient
-    for x in range(width):
-        r = start_color[0] + (end_color[0] - start_color[0]) * x // width
-        g = start_color[1] + (end_color[1] - start_color[1]) * x // width
-        b = start_color[2] + (end_color[2] - start_color[2]) * x // width
-        draw.line((x, 0, x, height), fill=(r, g, b))
+    image = draw_gradient(start_color, end_color, width, height)
+    draw = ImageDraw.Draw(image)
     # load font
     font = load_font('Solway', font_size)
     # get text size to center it
@@ -69,6 +90,17 @@ def draw_project_tree(
     project_tree: str,
     width: int=3524,
     height: int=2068,
+    cache: DiskCache=None
+) -> Image.Image:
+    key = DiskCache.make_key('tree', project_title, project_tree, width, height)
+    return get_cached_image(cache, key, lambda: _draw_project_tree(project_title, project_tree, width, height))
+
+
+def _draw_project_tree(
+    project_title: str,
+    project_tree: str,
+    width: int=3524,
+    height: int=2068,
 ) -> Image.Image:
     image = Image.new('RGB', (width, height), color=(0, 0, 0))
     draw = ImageDraw.Draw(image)
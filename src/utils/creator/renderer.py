@@ -0,0 +1,155 @@
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+from pygments import lex
+from pygments.token import Token
+from pygments.lexers import get_lexer_for_filename
+from pygments.lexers.special import TextLexer
+from pygments.styles import get_style_by_name
+from pygments.util import ClassNotFound
+from utils.creator.drawer import load_font
+
+
+"""
+This module is responsible for rendering code images in-process (pygments + pillow),
+it mimics the carbon look without starting node or a browser.
+"""
+
+
+BACKGROUND_COLOR = (171, 184, 195)
+WINDOW_CONTROLS_COLORS = ((255, 95, 86), (255, 189, 46), (39, 201, 63))
+FALLBACK_MONO_FONT = 'DejaVuSansMono.ttf'
+# opacity of lines outside the highlighted range
+DIMMED_OPACITY = 0.4
+LINE_HEIGHT_RATIO = 1.4
+TAB_SIZE = 4
+
+
+@lru_cache(maxsize=8)
+def load_mono_font(font_name: str, font_size: int) -> ImageFont.FreeTypeFont:
+    """Loads the requested font, falls back to a local monospace font when it cannot be fetched"""
+    try:
+        return load_font(font_name, font_size)
+    except Exception as e:
+        print(f'Could not load font {font_name}, using {FALLBACK_MONO_FONT}: {e}')
+    try:
+        return ImageFont.truetype(FALLBACK_MONO_FONT, font_size)
+    except OSError:
+        return ImageFont.load_default(font_size)
+
+
+@lru_cache(maxsize=8)
+def get_style(style_name: str) -> type:
+    # carbon theme names ('One Dark') -> pygments style names ('one-dark')
+    try:
+        return get_style_by_name(style_name.lower().replace(' ', '-'))
+    except ClassNotFound:
+        return get_style_by_name('one-dark')
+
+
+def hex_to_rgb(color: str) -> tuple:
+    color = color.lstrip('#')
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def blend(color: tuple, background: tuple, opacity: float) -> tuple:
+    return tuple(int(c * opacity + b * (1 - opacity)) for c, b in zip(color, background))
+
+
+def get_lexer(file_name: str):
+    options = dict(stripnl=False, stripall=False, ensurenl=False, tabsize=TAB_SIZE)
+    try:
+        return get_lexer_for_filename(file_name or '', **options)
+    except ClassNotFound:
+        return TextLexer(**options)
+
+
+def render_code(
+    code: str,
+    file_name: str=None,
+    highlight_start: int=None,
+    highlight_num_lines: int=1,
+    font_name: str='Space Mono',
+    style_name: str='One Dark',
+    first_line_number: int=1,
+    width: int=3524,
+    height: int=2068,
+) -> Image.Image:
+    """
+    Renders code like a carbon window: line numbers starting at first_line_number,
+    lines out of [highlight_start, highlight_start + highlight_num_lines) dimmed (1-based, relative to code).
+    """
+    style = get_style(style_name)
+    window_color = hex_to_rgb(style.background_color)
+    default_color = hex_to_rgb(style.style_for_token(Token.Text)['color'] or 'ABB2BF')
+    line_number_color = hex_to_rgb(style.style_for_token(Token.Comment)['color'] or '5C6370')
+    lines = code.expandtabs(TAB_SIZE).split('\n')
+    last_line_number = first_line_number + len(lines) - 1
+    gutter_columns = len(str(last_line_number)) + 2
+    num_columns = max(len(line) for line in lines) + gutter_columns
+    # layout, everything is relative to the image size
+    padding = int(width * 0.03)
+    window = (padding, padding, width - padding, height - padding)
+    inner_padding = int(width * 0.015)
+    header_height = int(height * 0.05)
+    available_width = window[2] - window[0] - 2 * inner_padding
+    available_height = window[3] - window[1] - 2 * inner_padding - header_height
+    # fit font size so that all columns & lines fit the window
+    char_ratio = load_mono_font(font_name, 100).getlength('M') / 100
+    font_size = int(min(
+        available_width / (num_columns * char_ratio),
+        available_height / (len(lines) * LINE_HEIGHT_RATIO),
+    ))
+    font = load_mono_font(font_name, max(font_size, 1))
+    char_width = font.getlength('M')
+    line_height = int(font_size * LINE_HEIGHT_RATIO)
+    # draw background & window
+    image = Image.new('RGB', (width, height), color=BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(image)
+    draw.rounded_rectangle(window, radius=int(width * 0.008), fill=window_color)
+    control_radius = header_height // 5
+    for i, color in enumerate(WINDOW_CONTROLS_COLORS):
+        x = window[0] + inner_padding + control_radius + i * control_radius * 3.5
+        y = window[1] + inner_padding + control_radius
+        draw.ellipse((x - control_radius, y - control_radius, x + control_radius, y + control_radius), fill=color)
+    # selected lines, all lines when no highlight
+    if highlight_start:
+        selected = range(highlight_start, highlight_start + (highlight_num_lines or 1))
+    else:
+        selected = range(1, len(lines) + 1)
+    x0 = window[0] + inner_padding
+    y0 = window[1] + inner_padding + header_height
+    code_x0 = x0 + gutter_columns * char_width
+    # colors computed once per token type & opacity
+    colors = {}
+
+    def get_color(ttype, is_selected: bool) -> tuple:
+        key = (ttype, is_selected)
+        if key not in colors:
+            color = style.style_for_token(ttype)['color']
+            color = hex_to_rgb(color) if color else default_color
+            colors[key] = color if is_selected else blend(color, window_color, DIMMED_OPACITY)
+        return colors[key]
+
+    # line numbers
+    for i in range(len(lines)):
+        color = line_number_color if (i + 1) in selected else blend(line_number_color, window_color, DIMMED_OPACITY)
+        number = str(first_line_number + i).rjust(gutter_columns - 2)
+        draw.text((x0, y0 + i * line_height), number, font=font, fill=color)
+    # tokens, the font is monospace so positions come from columns
+    line, column = 0, 0
+    for ttype, value in lex('\n'.join(lines), get_lexer(file_name)):
+        for j, part in enumerate(value.split('\n')):
+            if j:
+                line, column = line + 1, 0
+            if part.strip():
+                draw.text(
+                    (code_x0 + column * char_width, y0 + line * line_height),
+                    part, font=font, fill=get_color(ttype, (line + 1) in selected)
+                )
+            column += len(part)
+    return image
+
+
+if __name__ == '__main__':
+    code = 'def hello():\n    print("hello world")\n\nhello()'
+    render_code(code, 'main.py', highlight_start=2, highlight_num_lines=1).show()
@@ -1,8 +1,11 @@
 import os
 import json
+import shutil
 import tempfile
 import subprocess
 from PIL import Image
+from utils.cache import DiskCache
+from utils.creator.renderer import render_code
 
 
 """
@@ -10,46 +13,56 @@ This module is responsible for taking a screenshot of a code file.
 """
 
 
-# path to preset
+# path to the user's base preset, only read, each job writes its own copy
 CARBON_PRESET_PATH = os.path.join(os.path.expanduser('~'), '.carbon-now.json')
+CARBON_PRESET_NAME = 'latest-preset'
 SCRIPT_TEMPLATE = """
 @echo off
-REM Run carbon-now non-interactively with preset options on a file
+REM Run carbon-now non-interactively with a job-local preset on a file
 cd "{dir_path}"
-carbon-now "{file_name}"
-pause
+carbon-now "{file_name}" --config "{config_path}" --preset {preset_name} --save-to "{save_to}" --save-as {save_as}
 """
 
 
 def get_carbon_script(
     code: str,
     file_path: str,
+    job_dir: str,
     highlight_start: int=None,
     highlight_num_lines: int=None,
     font_name: str='Space Mono',
     style_name: str='One Dark',
     starting_line: int=1,
+    save_as: str='screenshot',
 ) -> str:
+    """
+    Writes a preset for this job only (inside job_dir) and returns the script running carbon-now with it.
+    The global preset is never modified, so several jobs can run at the same time.
+    """
     num_lines = len(code.split('\n'))
     with open(CARBON_PRESET_PATH, 'r') as f:
         preset = json.load(f)
-    preset['latest-preset']['fontFamily'] = font_name
-    preset['latest-preset']['theme'] = style_name
+    preset[CARBON_PRESET_NAME]['fontFamily'] = font_name
+    preset[CARBON_PRESET_NAME]['theme'] = style_name
     if highlight_start:
-        preset['latest-preset']['selectedLines'] = ','.join(
+        preset[CARBON_PRESET_NAME]['selectedLines'] = ','.join(
             map(str, list(range(highlight_start, min(highlight_start + highlight_num_lines, num_lines))))
         )
     else:
-        preset['latest-preset']['selectedLines'] = '*'
-    preset['latest-preset']['lineNumbers'] = "true"
-    preset['latest-preset']['firstLineNumber'] = starting_line
-    with open(CARBON_PRESET_PATH, 'w') as f:
+        preset[CARBON_PRESET_NAME]['selectedLines'] = '*'
+    preset[CARBON_PRESET_NAME]['lineNumbers'] = "true"
+    preset[CARBON_PRESET_NAME]['firstLineNumber'] = starting_line
+    config_path = os.path.join(job_dir, 'carbon-now.json')
+    with open(config_path, 'w') as f:
         json.dump(preset, f, indent=4)
     file_path = os.path.abspath(file_path)
-    print(f'Script: {SCRIPT_TEMPLATE.format(dir_path=os.path.dirname(file_path), file_name=os.path.basename(file_path))}')
     return SCRIPT_TEMPLATE.format(
         dir_path=os.path.dirname(file_path),
-        file_name=os.path.basename(file_path)
+        file_name=os.path.basename(file_path),
+        config_path=os.path.abspath(config_path),
+        preset_name=CARBON_PRESET_NAME,
+        save_to=os.path.abspath(job_dir),
+        save_as=save_as,
     )
 
 
@@ -126,36 +139,85 @@ def create_screenshot(
     highlight_num_lines: int=1,
     font_name: str='Space Mono',
     style_name: str='One Dark',
-    max_lines: int=40
+    max_lines: int=40,
+    backend: str='native',
+    cache: DiskCache=None
 ) -> Image.Image:
+    """
+    Creates a screenshot-like image of code, cropped around the highlighted lines.
+    backend is either 'native' (in-process pygments + pillow) or 'carbon' (carbon-now cli).
+    When a cache is given, images are looked up by the cropped code & rendering options first.
+    """
     code, start, highlight_start = crop_code_lines(code, highlight_start, highlight_num_lines, max_lines)
     code = crop_code_columns(code)
-    # save code to temporary file
-    file_path = os.path.join(cache_dir, file_rel_path or 'code.py')
-    if not os.path.exists(os.path.dirname(file_path)):
-        os.makedirs(os.path.dirname(file_path))
-    with open(file_path, 'w') as f:
-        f.write(code)
-        f.flush()
-    # pass parameters to script & save
-    script = get_carbon_script(
-        code, file_path,
-        highlight_start, highlight_num_lines,
-        font_name, style_name, starting_line=start+1
+    if cache is None:
+        return render_screenshot(
+            code, start, cache_dir, file_rel_path,
+            highlight_start, highlight_num_lines,
+            font_name, style_name, backend
+        )
+    # the file extension decides the language, so it is part of the key
+    key = DiskCache.make_key(
+        code, start, highlight_start, highlight_num_lines,
+        font_name, style_name, max_lines, backend,
+        os.path.splitext(file_rel_path or 'code.py')[1]
     )
-    script_path = create_temp_file(script, suffix='.bat')
-    # run script
-    subprocess.run(script_path, check=True)
-    # load screenshot
-    screenshot_path = max(
-        [os.path.join(os.path.dirname(file_path), f) for f in os.listdir(os.path.dirname(file_path)) if f.endswith('.png')],
-        key=os.path.getmtime
+    cached_path = cache.get(key, suffix='.png')
+    if cached_path:
+        return get_image_from_path(cached_path)
+    image_output = render_screenshot(
+        code, start, cache_dir, file_rel_path,
+        highlight_start, highlight_num_lines,
+        font_name, style_name, backend
     )
-    # screenshot_path = os.path.join(os.path.dirname(file_path), screenshot_path)
-    image_output = get_image_from_path(screenshot_path)
-    # cleanup, remove temp files
-    for file in (screenshot_path, script_path, file_path):
-        os.remove(file)
+    cache.put(key, lambda path: image_output.save(path, format='PNG'), suffix='.png')
+    return image_output
+
+
+def render_screenshot(
+    code: str,
+    start: int,
+    cache_dir: str,
+    file_rel_path: str=None,
+    highlight_start: int=None,
+    highlight_num_lines: int=1,
+    font_name: str='Space Mono',
+    style_name: str='One Dark',
+    backend: str='native'
+) -> Image.Image:
+    """Renders already cropped code (starting at line start+1) with the given backend"""
+    if backend == 'native':
+        return render_code(
+            code, file_rel_path or 'code.py',
+            highlight_start, highlight_num_lines,
+            font_name, style_name, first_line_number=start+1
+        )
+    if backend != 'carbon':
+        raise ValueError(f'Unknown screenshot backend: {backend}')
+    # every job works in its own directory (code file, preset, script & screenshot)
+    os.makedirs(cache_dir, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix='screenshot_', dir=cache_dir)
+    try:
+        # save code to job file, keep its name so carbon detects the language
+        file_path = os.path.join(job_dir, os.path.basename(file_rel_path or 'code.py'))
+        with open(file_path, 'w') as f:
+            f.write(code)
+        # pass parameters to script & save
+        script = get_carbon_script(
+            code, file_path, job_dir,
+            highlight_start, highlight_num_lines,
+            font_name, style_name, starting_line=start+1
+        )
+        script_path = os.path.join(job_dir, 'carbon.bat')
+        with open(script_path, 'w') as f:
+            f.write(script.strip())
+        # run script
+        subprocess.run(script_path, check=True)
+        # load screenshot
+        image_output = get_image_from_path(os.path.join(job_dir, 'screenshot.png'))
+    finally:
+        # cleanup, remove job files
+        shutil.rmtree(job_dir, ignore_errors=True)
     return image_output
 
 
@@ -163,6 +225,7 @@ if __name__ == '__main__':
     code = 'print("hello world")\nprint("hello world")\nprint("hello world")'
     img = create_screenshot(
         code,
+        cache_dir=tempfile.gettempdir(),
         file_rel_path='main.py',
     )
     img.show()
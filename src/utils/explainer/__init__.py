@@ -1,8 +1,12 @@
 import os
+import json
+import math
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from utils.explainer.codebase_parser import get_codebase
-from utils.explainer.llms import Gemini
+from utils.explainer.codebase_parser import ingest_codebase, CodebaseSnapshot, SourceFile
+from utils.explainer.llms import LLM, get_llm
 
 
 """
@@ -12,6 +16,16 @@ This package is responsible for explaining a code file into json format
 
 load_dotenv()
 curr_dir = os.path.dirname(os.path.abspath(__file__))
+# rough estimate, good enough for budgeting prompts
+CHARS_PER_TOKEN = 4
+# above this size the codebase is explained with map-reduce instead of a single prompt
+MAX_PROMPT_TOKENS = int(os.getenv('MAX_PROMPT_TOKENS', 400_000))
+# size of each codebase chunk in map-reduce mode
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', 100_000))
+# max number of chunks explained at the same time
+MAP_CONCURRENCY = int(os.getenv('MAP_CONCURRENCY', 4))
+# max number of files highlighted at the same time
+HIGHLIGHT_CONCURRENCY = int(os.getenv('HIGHLIGHT_CONCURRENCY', 4))
 
 
 class Explanation(BaseModel):
@@ -21,14 +35,47 @@ class Explanation(BaseModel):
     explanatory_text: str
 
 
+def read_prompt(name: str) -> str:
+    with open(f'{curr_dir}/{name}', 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def pack_files(snapshot: CodebaseSnapshot, chunk_tokens: int=CHUNK_TOKENS) -> list[CodebaseSnapshot]:
+    """Packs files (in order) into chunks of at most chunk_tokens, a bigger file gets a chunk of its own"""
+    chunks, chunk, chunk_size = [], CodebaseSnapshot(), 0
+    for file in snapshot.files:
+        file_size = estimate_tokens(snapshot.render_file(file))
+        if chunk.files and chunk_size + file_size > chunk_tokens:
+            chunks.append(chunk)
+            chunk, chunk_size = CodebaseSnapshot(), 0
+        chunk.files.append(file)
+        chunk_size += file_size
+    if chunk.files:
+        chunks.append(chunk)
+    return chunks
+
+
 def explain_codebase(
     dir_path: str, ignored_files: list[str],
-    num: int=20, user_instructions: str=''
+    num: int=20, user_instructions: str='',
+    snapshot: CodebaseSnapshot=None,
+    mode: str='auto',
+    llm: LLM=None
 ) -> list[dict]:
-    codebase_str = get_codebase(dir_path, ignored_files=ignored_files)
-    llm = Gemini(os.getenv('GENAI_API_KEY'))
-    with open(f'{curr_dir}/prompt_explain.txt', 'r', encoding='utf-8') as f:
-        prompt = f.read()
+    """
+    Explains the codebase, mode is 'single' (one prompt), 'map_reduce' (chunks explained concurrently,
+    then reduced to num explanations) or 'auto' (map_reduce only when the codebase is over MAX_PROMPT_TOKENS).
+    """
+    snapshot = snapshot or ingest_codebase(dir_path, ignored_files=ignored_files)
+    codebase_str = snapshot.render()
+    llm = llm or get_llm()
+    if mode == 'map_reduce' or (mode == 'auto' and estimate_tokens(codebase_str) > MAX_PROMPT_TOKENS):
+        return explain_codebase_map_reduce(llm, snapshot, num, user_instructions)
+    prompt = read_prompt('prompt_explain.txt')
     user_instructions = 'Few more specific instructions:\n' + user_instructions
     prompt = prompt.format(codebase=codebase_str, num_explanations=num, user_instructions=user_instructions)
     explanations = llm.generate(prompt)
@@ -36,13 +83,155 @@ def explain_codebase(
     return explanations
 
 
-def add_highlighting(dir_path: str, ignored_files: list[str], explanations: list[dict], max_highlight: int=30) -> list[dict]:
-    codebase_str = get_codebase(dir_path, ignored_files=ignored_files, show_line_numbers=True)
-    llm = Gemini(os.getenv('GENAI_API_KEY'))
-    with open(f'{curr_dir}/prompt_highlight.txt', 'r', encoding='utf-8') as f:
-        prompt = f.read()
-    prompt = prompt.format(codebase=codebase_str, explanations=explanations, max_highlight=max_highlight)
-    with open('prompt_temp.txt', 'w', encoding='utf-8') as f:
-        f.write(prompt)
-    updated_explanations = llm.generate(prompt)
+def explain_codebase_map_reduce(
+    llm: LLM,
+    snapshot: CodebaseSnapshot,
+    num: int=20,
+    user_instructions: str='',
+    chunk_tokens: int=CHUNK_TOKENS,
+    concurrency: int=MAP_CONCURRENCY
+) -> list[dict]:
+    chunks = pack_files(snapshot, chunk_tokens)
+    file_list = '\n'.join(file.rel_path for file in snapshot.files)
+    explain_prompt = read_prompt('prompt_explain.txt')
+    # every chunk proposes a share of the explanations proportional to its number of files
+    def explain_chunk(index: int, chunk: CodebaseSnapshot) -> list[dict]:
+        chunk_num = max(3, math.ceil(num * 1.5 * len(chunk.files) / len(snapshot.files)))
+        instructions = (
+            f'Few more specific instructions:\n'
+            f'This is only part {index + 1} of {len(chunks)} of the codebase, the whole project contains these files:\n'
+            f'{file_list}\n{user_instructions}'
+        )
+        prompt = explain_prompt.format(
+            codebase=chunk.render(), num_explanations=chunk_num, user_instructions=instructions
+        )
+        explanations = llm.generate(prompt)
+        return explanations if isinstance(explanations, list) else []
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        candidates = [
+            explanation
+            for explanations in executor.map(explain_chunk, range(len(chunks)), chunks)
+            for explanation in explanations
+        ]
+    print(f'Map-reduce: {len(chunks)} chunks, {len(candidates)} candidate explanations')
+    prompt = read_prompt('prompt_reduce.txt').format(
+        num_explanations=num,
+        user_instructions='Few more specific instructions:\n' + user_instructions,
+        file_list=file_list,
+        candidates=json.dumps(candidates, indent=1)
+    )
+    explanations = llm.generate(prompt)
+    return explanations if isinstance(explanations, list) else candidates[:num]
+
+
+def _highlight_group(
+    llm: LLM, snapshot: CodebaseSnapshot, file: SourceFile,
+    explanations: list[dict], max_highlight: int
+) -> list[dict]:
+    """Highlights explanations of one file, returns [] when the answer does not match them"""
+    prompt = read_prompt('prompt_highlight.txt').format(
+        codebase=snapshot.render_file(file, show_line_numbers=True),
+        explanations=explanations,
+        max_highlight=max_highlight
+    )
+    highlighted = llm.generate(prompt)
+    if not isinstance(highlighted, list) or len(highlighted) != len(explanations):
+        print(f'Highlighting {file.rel_path} failed, keeping explanations unhighlighted')
+        return []
+    return highlighted
+
+
+def add_highlighting(
+    dir_path: str, ignored_files: list[str], explanations: list[dict],
+    max_highlight: int=30, snapshot: CodebaseSnapshot=None,
+    concurrency: int=HIGHLIGHT_CONCURRENCY,
+    llm: LLM=None
+) -> list[dict]:
+    """
+    Adds start_line & end_line to explanations. Explanations are grouped by file, each group is sent
+    along with that file only (line-numbered), groups run concurrently and results keep the original order.
+    """
+    snapshot = snapshot or ingest_codebase(dir_path, ignored_files=ignored_files)
+    llm = llm or get_llm()
+    # general explanations (project idea, structure, unknown files) are not highlighted
+    updated_explanations = [dict(explanation, start_line=0, end_line=0) for explanation in explanations]
+    groups = {}
+    for i, explanation in enumerate(explanations):
+        file = snapshot.get_file(explanation['file_path']) if explanation.get('file_path') else None
+        if file is not None:
+            groups.setdefault(file.rel_path, (file, []))[1].append(i)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = executor.map(
+            lambda group: _highlight_group(llm, snapshot, group[0], [explanations[i] for i in group[1]], max_highlight),
+            groups.values()
+        )
+        for (file, indices), highlighted in zip(groups.values(), results):
+            for i, item in zip(indices, highlighted):
+                updated_explanations[i]['start_line'] = int(item.get('start_line') or 0)
+                updated_explanations[i]['end_line'] = int(item.get('end_line') or 0)
     return updated_explanations
+
+
+def stream_explanations(
+    dir_path: str, ignored_files: list[str],
+    num: int=20, user_instructions: str='',
+    snapshot: CodebaseSnapshot=None,
+    llm: LLM=None,
+    max_highlight: int=30,
+    concurrency: int=HIGHLIGHT_CONCURRENCY
+) -> Iterator[dict]:
+    """
+    Yields highlighted explanations in order, as soon as each one is ready: the explain answer is parsed
+    while it streams and every explanation is highlighted (alone) while the next ones are still generated.
+    Codebases over MAX_PROMPT_TOKENS are explained with map-reduce, which can only stream its highlighting.
+    """
+    snapshot = snapshot or ingest_codebase(dir_path, ignored_files=ignored_files)
+    codebase_str = snapshot.render()
+    llm = llm or get_llm()
+    if estimate_tokens(codebase_str) > MAX_PROMPT_TOKENS:
+        items = explain_codebase_map_reduce(llm, snapshot, num, user_instructions)
+    else:
+        items = _stream_explain(llm, snapshot, codebase_str, num, user_instructions)
+
+    def highlight(explanation: dict) -> dict:
+        explanation = dict(explanation, file_path=explanation.get('file_path') or '', start_line=0, end_line=0)
+        file = snapshot.get_file(explanation['file_path']) if explanation['file_path'] else None
+        if file is not None:
+            for item in _highlight_group(llm, snapshot, file, [explanation], max_highlight):
+                explanation['start_line'] = int(item.get('start_line') or 0)
+                explanation['end_line'] = int(item.get('end_line') or 0)
+        return Explanation(**explanation).model_dump()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        pending = []
+        for item in items:
+            if not isinstance(item, dict) or 'explanatory_text' not in item:
+                continue
+            pending.append(executor.submit(highlight, item))
+            # hand over finished explanations without waiting for the end of the stream
+            while pending and pending[0].done():
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def _stream_explain(
+    llm: LLM, snapshot: CodebaseSnapshot, codebase_str: str,
+    num: int, user_instructions: str
+) -> Iterator[dict]:
+    prompt = read_prompt('prompt_explain.txt').format(
+        codebase=codebase_str, num_explanations=num,
+        user_instructions='Few more specific instructions:\n' + user_instructions
+    )
+    count = 0
+    for item in llm.generate_json_stream(prompt):
+        # only objects are explanations, anything else is dropped downstream
+        count += isinstance(item, dict)
+        yield item
+    if not count:
+        # malformed answer, the non-streaming call retries it
+        print('Streamed answer had no explanations, retrying without streaming')
+        explanations = llm.generate(prompt)
+        yield from (explanations if isinstance(explanations, list) else [])
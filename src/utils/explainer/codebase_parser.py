@@ -1,5 +1,12 @@
 import os
-from directory_tree import DisplayTree
+import re
+import json
+import hashlib
+import threading
+from array import array
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from utils.profiling import span
 
 
 """
@@ -7,52 +14,399 @@ This module is responsible for parsing a codebase, mainly to wrap it for a model
 """
 
 
-def generate_codebase_tree(project_dir: str) -> str:
-    return DisplayTree(project_dir, stringRep=True).replace('\n', '\n\n')
+FILES_IGNORED_BY_DEFAULT = [
+    'png', 'jpg', 'jpeg', 'gif', 'svg', 'ico', 'bmp',
+    'pyc', 'pyo', 'pyd', 'pyclass', 'pyo',
+    'mp3', 'wav', 'ogg', 'flac', 'mid', 'midi', 'wma',
+    'mp4', 'mkv', 'avi', 'mov', 'wmv', 'flv',
+    'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx',
+    'zip', 'rar', '7z', 'tar', 'gz', 'bz2', 'tar.gz', 'tgz',
+    'exe', 'msi', 'dll', 'so', 'dylib', 'lib', 'a', 'o', 'log',
+    'pdf', 'csv', 'tsv', 'xml', 'json', 'ipynb'
+]
+FOLDERS_TO_IGNORE = [
+    'node_modules', '.git',
+    'venv', '.venv', '__pycache__',
+    '.pytest_cache', '.vscode',
+    'build', 'dist', '.mypy_cache',
+    '.ipynb_checkpoints',
+]
+# budgets, files over MAX_FILE_BYTES are skipped, ingestion stops at MAX_TOTAL_BYTES
+MAX_FILE_BYTES = int(os.getenv('MAX_FILE_BYTES', 256 * 1024))
+MAX_TOTAL_BYTES = int(os.getenv('MAX_TOTAL_BYTES', 8 * 1024 ** 2))
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', 8))
+BINARY_SNIFF_BYTES = 8192
+
+
+def number_lines(code: str) -> str:
+    return '\n'.join([f'{i+1}: {line}' for i, line in enumerate(code.split('\n'))])
 
 
 def read_code_file(file_path: str, add_line_numbers: bool=False) -> str:
     with open(file_path, 'r', encoding='utf-8') as file:
         code = file.read()
     if add_line_numbers:
-        code = '\n'.join([f'{i+1}: {line}' for i, line in enumerate(code.split('\n'))])
+        code = number_lines(code)
     return code
 
 
+def is_binary(data: bytes) -> bool:
+    """Sniffs content: null bytes or undecodable utf-8 in the first bytes mean binary"""
+    head = data[:BINARY_SNIFF_BYTES]
+    if b'\0' in head:
+        return True
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # a multi-byte character may be cut at the end of the sniffed bytes
+        return e.start < len(head) - 3
+    return False
+
+
+def _glob_to_regex(pattern: str) -> str:
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class GitIgnore:
+    """Matches paths against the .gitignore files found while walking a project"""
+    def __init__(self) -> None:
+        # (base dir relative to the project, regex, negated, directories only, anchored)
+        self.rules = []
+
+    def add_file(self, gitignore_path: str, base: str) -> None:
+        try:
+            with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            line = line[1:] if negated else line
+            dir_only = line.endswith('/')
+            # a leading or middle slash anchors the rule, the trailing one of dir-only rules does not
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            self.rules.append((base, re.compile(_glob_to_regex(line) + '$'), negated, dir_only, anchored))
+
+    def is_ignored(self, rel_path: str, is_dir: bool) -> bool:
+        ignored = False
+        for base, regex, negated, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not rel_path.startswith(base + '/'):
+                    continue
+                path = rel_path[len(base) + 1:]
+            else:
+                path = rel_path
+            target = path if anchored else path.rsplit('/', 1)[-1]
+            if regex.match(target):
+                ignored = not negated
+        return ignored
+
+
+@dataclass
+class SourceFile:
+    rel_path: str
+    code: str
+    sha1: str
+
+
+@dataclass
+class CodebaseSnapshot:
+    """In-memory snapshot of a codebase, rendered as a prompt with or without line numbers"""
+    files: list[SourceFile] = field(default_factory=list)
+    # relative path -> reason (binary, too large, duplicate of ..., over total budget)
+    skipped: dict = field(default_factory=dict)
+
+    def get_file(self, rel_path: str) -> SourceFile | None:
+        rel_path = os.path.normpath(rel_path).replace(os.sep, '/')
+        return next((file for file in self.files if file.rel_path == rel_path), None)
+
+    def render_file(self, file: SourceFile, show_line_numbers: bool=False) -> str:
+        code = number_lines(file.code) if show_line_numbers else file.code
+        return f'\n\n{file.rel_path}:\n```\n{code}\n```\n'
+
+    def render(self, show_line_numbers: bool=False) -> str:
+        return ''.join(self.render_file(file, show_line_numbers) for file in self.files)
+
+
+def list_files(dir_path: str, ignored_files: list[str]) -> list[str]:
+    """Walks the project once, pruning ignored folders & .gitignore matches"""
+    gitignore = GitIgnore()
+    file_paths = []
+    for root, folders, files in os.walk(dir_path):
+        rel_root = os.path.relpath(root, dir_path).replace(os.sep, '/')
+        rel_root = '' if rel_root == '.' else rel_root
+        if '.gitignore' in files:
+            gitignore.add_file(os.path.join(root, '.gitignore'), rel_root)
+        folders[:] = [
+            folder for folder in folders
+            if folder not in FOLDERS_TO_IGNORE
+            and not gitignore.is_ignored(f'{rel_root}/{folder}'.lstrip('/'), is_dir=True)
+        ]
+        for file in files:
+            file_extension = file.split('.')[-1]
+            if file_extension in ignored_files:
+                continue
+            if gitignore.is_ignored(f'{rel_root}/{file}'.lstrip('/'), is_dir=False):
+                continue
+            file_paths.append(os.path.join(root, file))
+    return file_paths
+
+
+def _read_head(file_path: str, max_bytes: int) -> bytes | None:
+    # reads one byte more than the budget to know if the file is over it
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read(max_bytes + 1)
+    except OSError:
+        return None
+
+
+def get_extension(file_name: str) -> str:
+    return file_name.split('.')[-1] if '.' in file_name else ''
+
+
+def _scan_file(file_path: str, max_bytes: int) -> tuple[str, int, bool] | None:
+    """Returns (sha1, line count, is binary) of a file, files over max_bytes are only sniffed (no hash)"""
+    data = _read_head(file_path, max_bytes)
+    if data is None:
+        return None
+    binary = is_binary(data)
+    if len(data) > max_bytes:
+        return '', 0, binary
+    line_count = 0 if binary else data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+    return hashlib.sha1(data).hexdigest(), line_count, binary
+
+
+@dataclass(frozen=True)
+class IndexColumns:
+    """One consistent version of the index table, never modified once published"""
+    paths: list[str] = field(default_factory=list)
+    extensions: list[str] = field(default_factory=list)
+    hashes: list[str] = field(default_factory=list)
+    sizes: array = field(default_factory=lambda: array('q'))
+    mtimes: array = field(default_factory=lambda: array('d'))
+    line_counts: array = field(default_factory=lambda: array('q'))
+    binary: array = field(default_factory=lambda: array('b'))
+
+    def select(self, ignored_files: list[str]=()) -> list[int]:
+        """Row indices of the files whose extension is not ignored, in walk order"""
+        ignored_files = set(ignored_files)
+        return [i for i, extension in enumerate(self.extensions) if extension not in ignored_files]
+
+
+class ProjectIndex:
+    """
+    Table of the project files, built from one walk (FOLDERS_TO_IGNORE & .gitignore honored) and shared
+    by every consumer. Columns: path, extension, size, mtime, sha1 ('' over MAX_FILE_BYTES), line count
+    & binary flag. refresh() only rereads files whose size or mtime changed.
+    Readers take `columns` once: a refresh publishes new columns in one assignment, so rows stay consistent.
+    """
+    def __init__(self, project_dir: str, columns: IndexColumns=None) -> None:
+        self.project_dir = project_dir
+        self.columns = columns or IndexColumns()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.columns.paths)
+
+    @classmethod
+    def build(cls, project_dir: str, num_workers: int=INGESTION_WORKERS) -> 'ProjectIndex':
+        index = cls(project_dir)
+        index.refresh(num_workers=num_workers)
+        return index
+
+    @span('index')
+    def refresh(self, max_bytes: int=MAX_FILE_BYTES, num_workers: int=INGESTION_WORKERS) -> int:
+        """Walks the project again, returns the number of rows changed (files added, modified or deleted)"""
+        with self._lock:
+            columns = self.columns
+            previous = {
+                path: (size, mtime, i)
+                for i, (path, size, mtime) in enumerate(zip(columns.paths, columns.sizes, columns.mtimes))
+            }
+            rows, to_scan = [], []
+            for file_path in list_files(self.project_dir, ignored_files=[]):
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                rel_path = os.path.relpath(file_path, self.project_dir).replace(os.sep, '/')
+                size, mtime, i = previous.get(rel_path, (None, None, None))
+                if size == stat.st_size and mtime == stat.st_mtime:
+                    row = (columns.hashes[i], columns.line_counts[i], columns.binary[i])
+                else:
+                    row = None
+                    to_scan.append(len(rows))
+                rows.append([rel_path, stat.st_size, stat.st_mtime, row])
+            with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+                scanned = executor.map(
+                    lambda j: _scan_file(os.path.join(self.project_dir, rows[j][0]), max_bytes), to_scan
+                )
+                for j, row in zip(to_scan, scanned):
+                    rows[j][3] = row
+            deleted = previous.keys() - {rel_path for rel_path, _, _, _ in rows}
+            rows = [row for row in rows if row[3] is not None]
+            paths = [rel_path for rel_path, _, _, _ in rows]
+            # built aside, then published at once
+            self.columns = IndexColumns(
+                paths=paths,
+                extensions=[get_extension(rel_path.rsplit('/', 1)[-1]) for rel_path in paths],
+                hashes=[row[0] for _, _, _, row in rows],
+                sizes=array('q', (size for _, size, _, _ in rows)),
+                mtimes=array('d', (mtime for _, _, mtime, _ in rows)),
+                line_counts=array('q', (row[1] for _, _, _, row in rows)),
+                binary=array('b', (row[2] for _, _, _, row in rows)),
+            )
+            return len(to_scan) + len(deleted)
+
+    def select(self, ignored_files: list[str]=()) -> tuple[IndexColumns, list[int]]:
+        """The current columns & the rows of the files whose extension is not ignored, in walk order"""
+        columns = self.columns
+        return columns, columns.select(ignored_files)
+
+    def get_extensions(self) -> list[str]:
+        return sorted({extension for extension in self.columns.extensions if extension})
+
+    def save(self, path: str) -> None:
+        columns = self.columns
+        data = json.dumps({
+            'paths': columns.paths,
+            'hashes': columns.hashes,
+            'sizes': columns.sizes.tolist(),
+            'mtimes': columns.mtimes.tolist(),
+            'line_counts': columns.line_counts.tolist(),
+            'binary': columns.binary.tolist(),
+        })
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str, project_dir: str) -> 'ProjectIndex':
+        """Loads a saved index (empty if missing or corrupted), call refresh() to bring it up to date"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls(project_dir)
+        return cls(project_dir, IndexColumns(
+            paths=data['paths'],
+            extensions=[get_extension(rel_path.rsplit('/', 1)[-1]) for rel_path in data['paths']],
+            hashes=data['hashes'],
+            sizes=array('q', data['sizes']),
+            mtimes=array('d', data['mtimes']),
+            line_counts=array('q', data['line_counts']),
+            binary=array('b', data['binary']),
+        ))
+
+
+def generate_codebase_tree(project_dir: str, index: ProjectIndex=None) -> str:
+    """Renders the project files as a tree (folders first), lines are separated by blank lines"""
+    index = index or ProjectIndex.build(project_dir)
+    root = {}
+    for rel_path in index.columns.paths:
+        node = root
+        *folders, file_name = rel_path.split('/')
+        for folder in folders:
+            node = node.setdefault(folder, {})
+        node[file_name] = None
+    lines = [f'{os.path.basename(os.path.abspath(project_dir))}/']
+
+    def render(node: dict, prefix: str) -> None:
+        entries = sorted(node.items(), key=lambda entry: (entry[1] is None, entry[0].lower()))
+        for i, (name, child) in enumerate(entries):
+            is_last = i == len(entries) - 1
+            lines.append(f'{prefix}{"└── " if is_last else "├── "}{name}{"" if child is None else "/"}')
+            if child is not None:
+                render(child, prefix + ('    ' if is_last else '│   '))
+
+    render(root, '')
+    return '\n\n'.join(lines)
+
+
+@span('ingest')
+def ingest_codebase(
+    dir_path: str,
+    ignored_files: list[str]=None,
+    max_file_bytes: int=MAX_FILE_BYTES,
+    max_total_bytes: int=MAX_TOTAL_BYTES,
+    num_workers: int=INGESTION_WORKERS,
+    index: ProjectIndex=None
+) -> CodebaseSnapshot:
+    """
+    Builds a snapshot of the codebase from the project index: binaries, duplicates & files over budgets
+    are skipped from the index alone, only the kept files are read (in parallel)
+    """
+    ignored_files = list(ignored_files or []) + FILES_IGNORED_BY_DEFAULT
+    index = index or ProjectIndex.build(dir_path, num_workers=num_workers)
+    snapshot = CodebaseSnapshot()
+    seen_hashes = {}
+    total_bytes = 0
+    kept = []
+    # one version of the index, even if another consumer refreshes it meanwhile
+    columns, rows = index.select(ignored_files)
+    for i in rows:
+        rel_path, size, sha1 = columns.paths[i], columns.sizes[i], columns.hashes[i]
+        if size > max_file_bytes:
+            snapshot.skipped[rel_path] = 'too large'
+        elif columns.binary[i]:
+            snapshot.skipped[rel_path] = 'binary'
+        elif total_bytes + size > max_total_bytes:
+            snapshot.skipped[rel_path] = 'over total budget'
+        elif sha1 in seen_hashes:
+            snapshot.skipped[rel_path] = f'duplicate of {seen_hashes[sha1]}'
+        else:
+            seen_hashes[sha1] = rel_path
+            total_bytes += size
+            kept.append((rel_path, sha1))
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        contents = executor.map(
+            lambda rel_path: _read_head(os.path.join(dir_path, rel_path), max_file_bytes),
+            [rel_path for rel_path, _ in kept]
+        )
+        for (rel_path, sha1), data in zip(kept, contents):
+            if data is None:
+                snapshot.skipped[rel_path] = 'unreadable'
+                continue
+            # same newlines as reading in text mode
+            code = data.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+            snapshot.files.append(SourceFile(rel_path, code, sha1))
+    return snapshot
+
+
 def get_codebase(
     dir_path: str, show_line_numbers: bool=False,
     ignored_files: list[str]=None
 ) -> str:
-    files_ignored_by_default = [
-        'png', 'jpg', 'jpeg', 'gif', 'svg', 'ico', 'bmp',
-        'pyc', 'pyo', 'pyd', 'pyclass', 'pyo',
-        'mp3', 'wav', 'ogg', 'flac', 'mid', 'midi', 'wma',
-        'mp4', 'mkv', 'avi', 'mov', 'wmv', 'flv',
-        'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx',
-        'zip', 'rar', '7z', 'tar', 'gz', 'bz2', 'tar.gz', 'tgz',
-        'exe', 'msi', 'dll', 'so', 'dylib', 'lib', 'a', 'o', 'log',
-        'pdf', 'csv', 'tsv', 'xml', 'json', 'ipynb'
-    ]
-    folders_to_ignore = [
-        'node_modules', '.git',
-        'venv', '.venv', '__pycache__',
-        '.pytest_cache', '.vscode',
-        'build', 'dist', '.mypy_cache',
-        '.ipynb_checkpoints',
-    ]
-    if not ignored_files:
-        ignored_files = []
-    ignored_files += files_ignored_by_default
-    codebase = ''
-    for root, folders, files in os.walk(dir_path):
-        for ignored_folder in folders_to_ignore:
-            if ignored_folder in folders:
-                folders.remove(ignored_folder)
-        for file in files:
-            file_extension = file.split('.')[-1]
-            if file_extension not in ignored_files:
-                file_path = os.path.join(root, file)
-                relative_file_path = os.path.relpath(file_path, dir_path)
-                codebase += f'\n\n{relative_file_path}:\n'
-                codebase += f'```\n{read_code_file(file_path, add_line_numbers=show_line_numbers)}\n```\n'
-    return codebase
+    return ingest_codebase(dir_path, ignored_files=ignored_files).render(show_line_numbers)
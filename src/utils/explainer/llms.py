@@ -1,7 +1,17 @@
+import os
 import re
+import ast
 import json
-from typing import Any
+import time
+import random
+import bisect
+import threading
+from typing import Any, Iterable, Iterator
+from functools import lru_cache
 from google import genai
+from utils.cache import DiskCache
+from utils.profiling import span
+from utils.limits import limit
 
 
 """
@@ -9,16 +19,421 @@ This module is responsible for providing LLM to explain code
 """
 
 
-class Gemini:
-    def __init__(self, api_key: str) -> None:
-        self.client = genai.Client(api_key=api_key, http_options={'api_version': 'v1alpha'})
+# which backend explains code: 'gemini' or 'stub' (deterministic, offline)
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini')
+# gemini quotas, shared by every call of the process
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', 10))
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', 4_000_000))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', 5))
+# retries when an answer has a malformed json block
+MAX_PARSE_RETRIES = 2
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, float('inf'))
+# an unfenced streamed answer starts at an array of objects (or an empty one)
+ARRAY_START_PATTERN = re.compile(r'\[\s*[{\]]')
+
+
+def parse_response(text: str) -> Any | str:
+    """Returns the json found in a ```json fenced block, or the raw text"""
+    json_match = re.search(r'(?s)```json\n(.*?)```', text)
+    if json_match:
+        json_str = json_match.group(1)
+        return json.loads(json_str)
+    return text
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """Token buckets for requests & tokens per minute, callers block until both allow the call"""
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int) -> None:
+        self.rates = (requests_per_minute / 60, tokens_per_minute / 60)
+        self.capacities = (requests_per_minute, tokens_per_minute)
+        self.levels = list(self.capacities)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.updated_at = now - self.updated_at, now
+        self.levels = [
+            min(capacity, level + rate * elapsed)
+            for level, rate, capacity in zip(self.levels, self.rates, self.capacities)
+        ]
+
+    def acquire(self, tokens: int) -> None:
+        # a single call bigger than the whole bucket is let through once the bucket is full
+        needed = (1, min(tokens, self.capacities[1]))
+        while True:
+            with self._lock:
+                self._refill()
+                missing = [max(0, need - level) for need, level in zip(needed, self.levels)]
+                if not any(missing):
+                    self.levels = [level - need for level, need in zip(self.levels, (1, tokens))]
+                    return
+                wait = max(amount / rate for amount, rate in zip(missing, self.rates))
+            time.sleep(wait)
+
+    def adjust(self, tokens: int) -> None:
+        """Charges (or refunds) the difference between estimated & actual tokens"""
+        with self._lock:
+            self.levels[1] -= tokens
+
+
+class LLMStats:
+    """Per-process accounting of llm calls: tokens, retries, errors & latency histogram"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+
+    def record(self, latency: float, input_tokens: int, output_tokens: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_sum += latency
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def record_error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'errors': self.errors,
+                'input_tokens': self.input_tokens,
+                'output_tokens': self.output_tokens,
+                'latency_sum': self.latency_sum,
+                'latency_histogram': dict(zip(map(str, LATENCY_BUCKETS), self.latency_counts)),
+            }
+
+
+RATE_LIMITER = RateLimiter(GEMINI_RPM, GEMINI_TPM)
+LLM_STATS = LLMStats()
+
+
+@lru_cache(maxsize=None)
+def get_client(api_key: str) -> genai.Client:
+    """One client (and connection pool) per api key & process, shared by all calls"""
+    return genai.Client(api_key=api_key, http_options={'api_version': 'v1alpha'})
+
+
+def is_retryable(error: Exception) -> bool:
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if code in RETRYABLE_STATUS_CODES:
+        return True
+    # network errors (connection reset, timeouts)
+    return isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in (
+        'ConnectError', 'ReadTimeout', 'RemoteProtocolError', 'ReadError'
+    )
+
+
+def backoff_delay(attempt: int, base: float=1.0, cap: float=60.0) -> float:
+    # exponential backoff with full jitter, so concurrent callers do not retry all at once
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _skip_to_array(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Yields the text from the opening bracket of the answer on: the first [ after a ```json fence or,
+    without fence, the first [ opening an array of objects (brackets in a preamble, like "[20]", are skipped)
+    """
+    chunks = iter(chunks)
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        fence = pending.find('```json')
+        if fence != -1:
+            start = pending.find('[', fence)
+        else:
+            match = ARRAY_START_PATTERN.search(pending)
+            start = match.start() if match else -1
+        if start != -1:
+            yield pending[start:]
+            yield from chunks
+            return
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Any]:
+    """
+    Incrementally parses a json array arriving in text chunks (fenced or not, see _skip_to_array),
+    yields each element as soon as it is complete.
+    """
+    started = False
+    depth = 0
+    in_string, escaped = False, False
+    element = []
+    for chunk in _skip_to_array(chunks):
+        for char in chunk:
+            if not started:
+                started = char == '['
+                continue
+            if depth == 0 and not in_string and char in '], \t\r\n':
+                # end of a scalar element (numbers, literals)
+                if element:
+                    yield json.loads(''.join(element))
+                    element = []
+                if char == ']':
+                    return
+                continue
+            element.append(char)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+                    if depth == 0:
+                        yield json.loads(''.join(element))
+                        element = []
+            elif char == '"':
+                in_string = True
+            elif char in '[{':
+                depth += 1
+            elif char in ']}':
+                depth -= 1
+                if depth == 0:
+                    yield json.loads(''.join(element))
+                    element = []
+
+
+class LLM:
+    """Interface of the models explaining code, backends only implement generate_text"""
+    model = ''
+    # generation settings, part of the cache key
+    config = {}
+
     def generate(self, prompt: str) -> Any | str:
-        response = self.client.models.generate_content(
-            model='gemini-2.0-flash-thinking-exp',
-            contents=prompt
-        )
-        json_match = re.search(r'(?s)```json\n(.*?)```', response.text)
-        if json_match:
-            json_str = json_match.group(1)
-            return json.loads(json_str)
-        return response.text
+        for attempt in range(MAX_PARSE_RETRIES + 1):
+            try:
+                with limit('llm'), span('llm', model=self.model, prompt_tokens=estimate_tokens(prompt)):
+                    return parse_response(self.generate_text(prompt))
+            except json.JSONDecodeError as e:
+                if attempt == MAX_PARSE_RETRIES:
+                    raise
+                print(f'{self.model} answered malformed json ({e}), retrying')
+
+    def generate_text(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    def generate_stream(self, prompt: str) -> Iterator[str]:
+        """Yields the answer in text chunks, backends without streaming yield it at once"""
+        yield self.generate_text(prompt)
+
+    def generate_json_stream(self, prompt: str) -> Iterator[Any]:
+        """Yields the elements of the json array answered by the model as they arrive"""
+        # the span includes the time spent by the consumer between elements
+        with limit('llm'), span('llm_stream', model=self.model, prompt_tokens=estimate_tokens(prompt)):
+            yield from iter_json_array(self.generate_stream(prompt))
+
+
+class Gemini(LLM):
+    model = 'gemini-2.0-flash-thinking-exp'
+
+    def __init__(self, api_key: str, rate_limiter: RateLimiter=RATE_LIMITER) -> None:
+        self.client = get_client(api_key)
+        self.rate_limiter = rate_limiter
+
+    def generate_text(self, prompt: str) -> str:
+        estimated_tokens = estimate_tokens(prompt)
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            start = time.perf_counter()
+            try:
+                response = self.client.models.generate_content(
+                    model=self.model,
+                    contents=prompt
+                )
+            except Exception as e:
+                if attempt == GEMINI_MAX_RETRIES or not is_retryable(e):
+                    LLM_STATS.record_error()
+                    raise
+                LLM_STATS.record_retry()
+                delay = backoff_delay(attempt)
+                print(f'{self.model} call failed ({e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+                continue
+            usage = response.usage_metadata
+            input_tokens = (usage and usage.prompt_token_count) or estimated_tokens
+            output_tokens = (usage and (
+                (usage.candidates_token_count or 0) + (getattr(usage, 'thoughts_token_count', 0) or 0)
+            )) or 0
+            self.rate_limiter.adjust(input_tokens + output_tokens - estimated_tokens)
+            LLM_STATS.record(time.perf_counter() - start, input_tokens, output_tokens)
+            return response.text
+
+    def generate_stream(self, prompt: str) -> Iterator[str]:
+        estimated_tokens = estimate_tokens(prompt)
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            start = time.perf_counter()
+            received = False
+            usage = None
+            try:
+                for chunk in self.client.models.generate_content_stream(
+                    model=self.model,
+                    contents=prompt
+                ):
+                    usage = chunk.usage_metadata or usage
+                    if chunk.text:
+                        received = True
+                        yield chunk.text
+            except Exception as e:
+                # once text was yielded the call cannot be replayed
+                if received or attempt == GEMINI_MAX_RETRIES or not is_retryable(e):
+                    LLM_STATS.record_error()
+                    raise
+                LLM_STATS.record_retry()
+                delay = backoff_delay(attempt)
+                print(f'{self.model} stream failed ({e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+                continue
+            input_tokens = (usage and usage.prompt_token_count) or estimated_tokens
+            output_tokens = (usage and (
+                (usage.candidates_token_count or 0) + (getattr(usage, 'thoughts_token_count', 0) or 0)
+            )) or 0
+            self.rate_limiter.adjust(input_tokens + output_tokens - estimated_tokens)
+            LLM_STATS.record(time.perf_counter() - start, input_tokens, output_tokens)
+            return
+
+
+class StubLLM(LLM):
+    """
+    Deterministic offline backend, answers are canned explanations built from the prompt itself
+    (files of the codebase, requested number of explanations, explanations to highlight or to reduce).
+    """
+    model = 'stub'
+
+    def generate_text(self, prompt: str) -> str:
+        # the kind of prompt is told by its first words (the codebase may quote any prompt)
+        if prompt.startswith('Your task is to annotate the explanations'):
+            answer = self._highlight(prompt)
+        elif prompt.startswith('I will provide you with candidate explanations'):
+            answer = self._reduce(prompt)
+        else:
+            answer = self._explain(prompt)
+        return f'```json\n{json.dumps(answer, indent=4)}\n```'
+
+    @staticmethod
+    def _get_section(prompt: str, start: str, end: str=None) -> str:
+        section = prompt.split(start, 1)[-1]
+        return section.split(end, 1)[0] if end else section
+
+    def _explain(self, prompt: str) -> list[dict]:
+        files = re.findall(r'\n\n(.+?):\n```\n', prompt)
+        num_match = re.search(r'write only around (\d+) explanations', prompt)
+        num = int(num_match.group(1)) if num_match else 20
+        explanations = [
+            {'file_path': '', 'explanatory_text': 'This project is explained by a stub model.'},
+            {'file_path': './', 'explanatory_text': f'The project is organized in {len(files)} files.'},
+        ]
+        for i in range(max(0, num - len(explanations))):
+            if not files:
+                break
+            file_path = files[i % len(files)]
+            explanations.append({
+                'file_path': file_path,
+                'explanatory_text': f'Part {i // len(files) + 1} of {file_path}. It plays its role in the project.'
+            })
+        return explanations
+
+    def _highlight(self, prompt: str) -> list[dict]:
+        section = self._get_section(prompt, 'Here is the json containing explanations:', 'Here is the codebase')
+        try:
+            explanations = ast.literal_eval(section.strip())
+        except (ValueError, SyntaxError):
+            return []
+        num_lines = len(re.findall(r'(?m)^\d+: ', prompt))
+        highlighted = []
+        for i, explanation in enumerate(explanations):
+            start_line = min(1 + i * 10, max(num_lines, 1))
+            highlighted.append(dict(
+                explanation,
+                start_line=start_line,
+                end_line=min(start_line + 9, max(num_lines, 1))
+            ))
+        return highlighted
+
+    def _reduce(self, prompt: str) -> list[dict]:
+        try:
+            candidates = json.loads(self._get_section(prompt, 'Here are the candidate explanations:').strip())
+        except ValueError:
+            return []
+        num_match = re.search(r'Select and order around (\d+) explanations', prompt)
+        num = int(num_match.group(1)) if num_match else 20
+        return candidates[:num]
+
+
+class CachedLLM(LLM):
+    """Wraps a backend, answers are cached on disk by hash of (model, config, prompt)"""
+    def __init__(self, llm: LLM, cache: DiskCache) -> None:
+        self.llm = llm
+        self.model = llm.model
+        self.config = llm.config
+        self.cache = cache
+
+    def generate_text(self, prompt: str) -> str:
+        key = DiskCache.make_key(self.llm.model, self.llm.config, prompt)
+        cached_path = self.cache.get(key, suffix='.txt')
+        if cached_path:
+            with open(cached_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        text = self.llm.generate_text(prompt)
+        # malformed answers are not cached, so a retry asks the model again
+        parse_response(text)
+
+        def write(path: str) -> None:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+
+        self.cache.put(key, write, suffix='.txt')
+        return text
+
+    def generate_stream(self, prompt: str) -> Iterator[str]:
+        key = DiskCache.make_key(self.llm.model, self.llm.config, prompt)
+        cached_path = self.cache.get(key, suffix='.txt')
+        if cached_path:
+            with open(cached_path, 'r', encoding='utf-8') as f:
+                yield f.read()
+            return
+        chunks = []
+        for chunk in self.llm.generate_stream(prompt):
+            chunks.append(chunk)
+            yield chunk
+        text = ''.join(chunks)
+        try:
+            parse_response(text)
+        except json.JSONDecodeError:
+            return
+
+        def write(path: str) -> None:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+
+        self.cache.put(key, write, suffix='.txt')
+
+
+def get_llm(backend: str=LLM_BACKEND, cache: DiskCache=None) -> LLM:
+    if backend == 'stub':
+        llm = StubLLM()
+    elif backend == 'gemini':
+        llm = Gemini(os.getenv('GENAI_API_KEY'))
+    else:
+        raise ValueError(f'Unknown llm backend: {backend}')
+    return CachedLLM(llm, cache) if cache is not None else llm
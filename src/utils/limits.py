@@ -0,0 +1,51 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+"""
+This module is responsible for process-wide concurrency limits per resource class,
+shared by every job of the process (batch mode runs several videos at once).
+"""
+
+
+# max concurrent uses per resource class, 0 means unlimited (each pipeline keeps its own limits)
+LIMITS = {
+    'llm': int(os.getenv('MAX_LLM_CALLS', 0)),
+    # syntheses beyond the tts workers would only queue (or share one in-process model)
+    'tts': int(os.getenv('MAX_TTS_JOBS', os.getenv('TTS_WORKERS', 1))),
+    'render': int(os.getenv('MAX_RENDER_JOBS', 0)),
+    'encode': int(os.getenv('MAX_ENCODE_JOBS', 0)),
+}
+
+
+class ResourceLimits:
+    """One semaphore per limited resource class, unlimited classes are not tracked"""
+    def __init__(self, limits: dict) -> None:
+        self.semaphores = {}
+        self._lock = threading.Lock()
+        for name, max_concurrency in limits.items():
+            self.set_limit(name, max_concurrency)
+
+    def set_limit(self, name: str, max_concurrency: int) -> None:
+        """Changes a limit, holders of the previous semaphore are not affected"""
+        with self._lock:
+            if max_concurrency > 0:
+                self.semaphores[name] = threading.BoundedSemaphore(max_concurrency)
+            else:
+                self.semaphores.pop(name, None)
+
+    @contextmanager
+    def limit(self, name: str):
+        """Blocks until a slot of the resource class is free, holds it for the block"""
+        with self._lock:
+            semaphore = self.semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+
+RESOURCE_LIMITS = ResourceLimits(LIMITS)
+limit = RESOURCE_LIMITS.limit
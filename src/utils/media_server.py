@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+"""
+This module is responsible for serving the generated videos over http: range requests (seeking),
+streamed from disk in chunks (never loaded in memory) & with their real content type.
+"""
+
+
+MEDIA_PORT = int(os.getenv('MEDIA_PORT', 8502))
+# base url of the server as seen by the browser (e.g. behind a proxy or on another host)
+MEDIA_URL = os.getenv('MEDIA_URL', f'http://localhost:{MEDIA_PORT}')
+CHUNK_BYTES = 1024 ** 2
+# only published names are served, nothing else of the directory (no traversal)
+NAME_PATTERN = re.compile(r'^/([0-9a-f]{32}\.mp4)$')
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+_media_server = None
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    # set by start_media_server
+    directory = None
+
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def _serve(self, send_body: bool) -> None:
+        path, _, query = self.path.partition('?')
+        match = NAME_PATTERN.match(path)
+        file_path = os.path.join(self.directory, match.group(1)) if match else None
+        if file_path is None or not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(file_path)
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            range_match = RANGE_PATTERN.match(range_header.strip())
+            if not range_match or range_match.groups() == ('', ''):
+                self._send_unsatisfiable(size)
+                return
+            first, last = range_match.groups()
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                # suffix range: the last bytes
+                start = max(0, size - int(last))
+            if start > end or start >= size:
+                self._send_unsatisfiable(size)
+                return
+        self.send_response(206 if range_header else 200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if range_header:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        if 'download' in query.split('&'):
+            self.send_header('Content-Disposition', 'attachment; filename="code_explainer_tutorial.mp4"')
+        self.end_headers()
+        if not send_body:
+            return
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_BYTES, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # the player seeked or the page was closed
+                pass
+
+    def _send_unsatisfiable(self, size: int) -> None:
+        self.send_response(416)
+        self.send_header('Content-Range', f'bytes */{size}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        # range requests are not logged
+        pass
+
+
+def start_media_server(directory: str, port: int=MEDIA_PORT) -> ThreadingHTTPServer | None:
+    """Serves the videos of directory in a daemon thread, once per process (no-op when port is 0)"""
+    global _media_server
+    if not port or _media_server is not None:
+        return _media_server
+    handler = type('DirectoryMediaHandler', (MediaHandler,), {'directory': directory})
+    try:
+        _media_server = ThreadingHTTPServer(('', port), handler)
+    except OSError as e:
+        # e.g. another app process already serves the same directory
+        print(f'Could not start media server on port {port}: {e}')
+        return None
+    threading.Thread(target=_media_server.serve_forever, daemon=True).start()
+    print(f'Videos served at {MEDIA_URL}')
+    return _media_server
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
+"""
+This module is responsible for pipeline instrumentation: spans timing every stage
+(exported as json lines & prometheus text) and an opt-in cProfile hook per stage.
+"""
+
+
+# every finished span is appended to this file (json lines), unset to keep spans in memory only
+SPANS_PATH = os.getenv('PROFILE_SPANS_PATH')
+# comma-separated stages to run under cProfile ('all' for every stage), dumps go to PROFILE_DIR
+PROFILE_STAGES = {stage for stage in os.getenv('PROFILE_STAGES', '').split(',') if stage}
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# port of the prometheus text endpoint (/metrics), 0 to disable
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# number of spans kept in memory
+MAX_SPANS = 10_000
+
+
+def get_peak_rss() -> int | None:
+    """Peak resident memory of the process since it started, in bytes (None where unsupported)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_rss() -> int | None:
+    """Current resident memory of the process in bytes (None where unsupported)"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _delta(start: int | None, end: int | None) -> int | None:
+    return end - start if start is not None and end is not None else None
+
+
+class Span:
+    """
+    One timed execution of a stage, labels identify it (slide, model, output file...).
+    Memory is measured for the whole process (concurrent stages of other threads are included):
+    rss_delta is the resident memory at the end minus at the start, peak_rss_growth how much the
+    stage raised the process peak, process_peak_rss the process peak since it started.
+    """
+    def __init__(self, stage: str, labels: dict) -> None:
+        self.stage = stage
+        self.labels = labels
+        self.bytes_written = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.rss_delta = None
+        self.peak_rss_growth = None
+        self.process_peak_rss = None
+        self.error = None
+
+    def add_output(self, path: str) -> None:
+        """Counts the size of a file written by the stage"""
+        try:
+            self.bytes_written += os.path.getsize(path)
+        except OSError:
+            pass
+
+    def to_dict(self) -> dict:
+        return {
+            'stage': self.stage,
+            'labels': self.labels,
+            'wall_time': round(self.wall_time, 6),
+            'cpu_time': round(self.cpu_time, 6),
+            'rss_delta': self.rss_delta,
+            'peak_rss_growth': self.peak_rss_growth,
+            'process_peak_rss': self.process_peak_rss,
+            'bytes_written': self.bytes_written,
+            'error': self.error,
+        }
+
+
+class Profiler:
+    """Collects spans & per-stage totals, shared by all threads of the process"""
+    def __init__(self, spans_path: str=None, profile_stages: set=frozenset(), profile_dir: str=PROFILE_DIR) -> None:
+        self.spans = deque(maxlen=MAX_SPANS)
+        # stage -> [calls, errors, wall time, cpu time, bytes written]
+        self.totals = {}
+        self.spans_path = spans_path
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        # only one cProfile can be active at a time
+        self._profile_lock = threading.Lock()
+        self._profile_count = 0
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        Times the block: wall time, cpu time of the calling thread (work done in child processes,
+        like ffmpeg or tts workers, is not included), memory (see Span) & bytes written.
+        """
+        span = Span(stage, labels)
+        profile = self._start_profile(stage)
+        start_rss, start_peak_rss = get_rss(), get_peak_rss()
+        start_wall, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.wall_time = time.perf_counter() - start_wall
+            span.cpu_time = time.thread_time() - start_cpu
+            span.process_peak_rss = get_peak_rss()
+            span.rss_delta = _delta(start_rss, get_rss())
+            span.peak_rss_growth = _delta(start_peak_rss, span.process_peak_rss)
+            if profile is not None:
+                self._stop_profile(stage, profile)
+            self.record(span)
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+            totals = self.totals.setdefault(span.stage, [0, 0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += span.error is not None
+            totals[2] += span.wall_time
+            totals[3] += span.cpu_time
+            totals[4] += span.bytes_written
+            if self.spans_path:
+                with open(self.spans_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(span.to_dict()) + '\n')
+
+    def _start_profile(self, stage: str) -> cProfile.Profile | None:
+        if stage not in self.profile_stages and 'all' not in self.profile_stages:
+            return None
+        # concurrent stages are not profiled, the profiler would mix their calls
+        if not self._profile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiling tool is active
+            self._profile_lock.release()
+            return None
+        return profile
+
+    def _stop_profile(self, stage: str, profile: cProfile.Profile) -> None:
+        profile.disable()
+        self._profile_count += 1
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile.dump_stats(f'{self.profile_dir}/{stage}-{os.getpid()}-{self._profile_count}.prof')
+        self._profile_lock.release()
+
+    def summary(self) -> dict:
+        """Totals per stage"""
+        with self._lock:
+            return {
+                stage: {
+                    'calls': calls, 'errors': errors,
+                    'wall_time': round(wall_time, 3), 'cpu_time': round(cpu_time, 3),
+                    'bytes_written': bytes_written,
+                }
+                for stage, (calls, errors, wall_time, cpu_time, bytes_written) in self.totals.items()
+            }
+
+    def export_jsonl(self, path: str) -> None:
+        with self._lock:
+            lines = [json.dumps(span.to_dict()) + '\n' for span in self.spans]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    def to_prometheus(self) -> str:
+        """Totals per stage in the prometheus text exposition format"""
+        metrics = (
+            ('cevaig_stage_calls_total', 'counter', 'Finished spans per stage', 'calls'),
+            ('cevaig_stage_errors_total', 'counter', 'Failed spans per stage', 'errors'),
+            ('cevaig_stage_wall_seconds_total', 'counter', 'Wall time spent per stage', 'wall_time'),
+            ('cevaig_stage_cpu_seconds_total', 'counter', 'Cpu time spent per stage', 'cpu_time'),
+            ('cevaig_stage_bytes_written_total', 'counter', 'Bytes written per stage', 'bytes_written'),
+        )
+        summary = self.summary()
+        lines = []
+        for name, kind, description, field in metrics:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{{stage="{stage}"}} {totals[field]}' for stage, totals in summary.items()]
+        process_peak_rss = get_peak_rss()
+        if process_peak_rss is not None:
+            lines += [
+                '# HELP cevaig_process_peak_rss_bytes Peak resident memory of the process since it started',
+                '# TYPE cevaig_process_peak_rss_bytes gauge',
+                f'cevaig_process_peak_rss_bytes {process_peak_rss}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+PROFILER = Profiler(SPANS_PATH, PROFILE_STAGES)
+span = PROFILER.span
+_metrics_server = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = PROFILER.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        # scrapes are not logged
+        pass
+
+
+def start_metrics_server(port: int=METRICS_PORT) -> ThreadingHTTPServer | None:
+    """Serves /metrics in a daemon thread, once per process (no-op when port is 0)"""
+    global _metrics_server
+    if not port or _metrics_server is not None:
+        return _metrics_server
+    try:
+        _metrics_server = ThreadingHTTPServer(('', port), MetricsHandler)
+    except OSError as e:
+        # e.g. streamlit reruns in another process holding the port
+        print(f'Could not start metrics server on port {port}: {e}')
+        return None
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    print(f'Metrics served at http://localhost:{port}/metrics')
+    return _metrics_server
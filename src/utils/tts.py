@@ -1,6 +1,17 @@
+import os
+import re
+import threading
 import numpy as np
 import soundfile as sf
+import multiprocessing
+from typing import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+# sets the model store (and offline mode) before kokoro loads huggingface hub
+from utils.assets import MODEL_REPO_ID
 from kokoro import KPipeline
+from utils.cache import DiskCache
+from utils.profiling import span
+from utils.limits import limit
 
 
 """
@@ -8,26 +19,155 @@ This package is responsible for converting text to engaging audio using AI.
 """
 
 
+SAMPLE_RATE = 24000
+# kokoro is fed one sentence at a time
+SENTENCE_SPLIT_PATTERN = r'(?<=[.!?])\s+'
+# rough narration rate at speed 1.0, used to preallocate the output buffer
+SAMPLES_PER_CHARACTER = SAMPLE_RATE // 14
+
+
 class SpeechTextConverter:
-    def __init__(self, speed: float=1.0):
-        # create pipeline fot english tts
-        self.pipeline = KPipeline(lang_code='a', repo_id='hexgrad/Kokoro-82M')
+    def __init__(
+        self,
+        speed: float=1.0,
+        cache: DiskCache=None,
+        num_workers: int=1,
+        torch_threads: int=None
+    ):
+        self.repo_id = MODEL_REPO_ID
         # set voice
         self.voice = 'af_heart'
         self.speed = speed
+        # synthesized audios are stored as raw float32 pcm, keyed on (text, voice, speed, model)
+        self.cache = cache
+        # with several workers, each worker process loads its own model & gets texts as jobs
+        self.num_workers = max(1, num_workers)
+        self.pipeline, self.executor = None, None
+        # the in-process model is not thread-safe, converters are shared by concurrent jobs
+        self._pipeline_lock = threading.Lock()
+        if self.num_workers > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.speed, self.voice, torch_threads)
+            )
+        else:
+            set_torch_threads(torch_threads)
+            # create pipeline fot english tts
+            self.pipeline = KPipeline(lang_code='a', repo_id=self.repo_id)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def str_to_audio(self, text: str, on_chunk: Callable[[np.ndarray], None]=None) -> tuple:
+        """
+        Synthesizes text one sentence at a time. on_chunk gets every audio chunk as soon as kokoro produces it,
+        so later stages (like encoding the slide audio) run alongside the synthesis of the next sentences.
+        Cached audios and audios synthesized by worker processes come as a single chunk.
+        """
+        with limit('tts'), span('tts', characters=len(text)):
+            return self._str_to_audio(text, on_chunk)
+
+    def _str_to_audio(self, text: str, on_chunk: Callable[[np.ndarray], None]=None) -> tuple:
+        key = DiskCache.make_key(text, self.voice, self.speed, self.repo_id, SAMPLE_RATE)
+        cached_path = self.cache.get(key, suffix='.f32') if self.cache is not None else None
+        if cached_path:
+            audio = np.memmap(cached_path, dtype=np.float32, mode='r')
+            if on_chunk is not None:
+                on_chunk(audio)
+            return SAMPLE_RATE, audio
+        if self.executor is not None:
+            sr, audio = self.executor.submit(_synthesize_in_worker, text).result()
+            if self.cache is not None:
+                self.cache.put(key, audio.tofile, suffix='.f32')
+            if on_chunk is not None:
+                on_chunk(audio)
+            return sr, audio
+        if self.cache is None:
+            return self._synthesize(text, on_chunk)
+        # the cached file is written from the chunks as they come, & published once complete
+        with self.cache.writing(key, suffix='.f32') as temp_path, open(temp_path, 'wb') as f:
+            def write(chunk: np.ndarray) -> None:
+                chunk.tofile(f)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+            return self._synthesize(text, write)
+
+    def _stream(self, text: str) -> Iterator[np.ndarray]:
+        """Yields float32 audio chunks, one per sentence, as kokoro produces them"""
+        with self._pipeline_lock:
+            generator = self.pipeline(
+                text,
+                voice=self.voice,
+                speed=self.speed,
+                split_pattern=SENTENCE_SPLIT_PATTERN
+            )
+            for gs, ps, audio in generator:
+                if audio is not None:
+                    yield np.asarray(audio, dtype=np.float32)
+
+    def _synthesize(self, text: str, on_chunk: Callable[[np.ndarray], None]=None) -> tuple:
+        # chunks are written into one preallocated buffer, grown only if the estimate was too short
+        buffer = np.empty(int(len(text) * SAMPLES_PER_CHARACTER / self.speed) + SAMPLE_RATE, dtype=np.float32)
+        length = 0
+        for chunk in self._stream(text):
+            if length + len(chunk) > len(buffer):
+                buffer = np.resize(buffer, max(2 * len(buffer), length + len(chunk)))
+            buffer[length:length + len(chunk)] = chunk
+            length += len(chunk)
+            if on_chunk is not None:
+                on_chunk(chunk)
+        if not length:
+            raise Exception('Audio generation failed')
+        # shrink in place, a slice would keep the whole over-allocated buffer alive
+        buffer.resize(length, refcheck=False)
+        return SAMPLE_RATE, buffer
+
+
+class StubSpeechTextConverter(SpeechTextConverter):
+    """
+    Deterministic offline stand-in, no model is loaded: the audio is a quiet tone
+    lasting as long as the narration would (SAMPLES_PER_CHARACTER), used by benchmarks.
+    """
+    def __init__(self, speed: float=1.0, cache: DiskCache=None, num_workers: int=1, torch_threads: int=None):
+        self.repo_id = 'stub'
+        self.voice = 'stub'
+        self.speed = speed
+        self.cache = cache
+        self.num_workers = max(1, num_workers)
+        self.pipeline, self.executor = None, None
+
+    def _stream(self, text: str) -> Iterator[np.ndarray]:
+        # one chunk per sentence, like kokoro
+        for sentence in re.split(SENTENCE_SPLIT_PATTERN, text):
+            times = np.arange(int(len(sentence) * SAMPLES_PER_CHARACTER / self.speed), dtype=np.float32) / SAMPLE_RATE
+            if len(times):
+                yield (0.1 * np.sin(2 * np.pi * 440 * times)).astype(np.float32)
+
+
+def set_torch_threads(torch_threads: int=None) -> None:
+    """Limits torch intra-op threads, so several workers do not oversubscribe the cpu"""
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+
+
+# the converter owned by a worker process of SpeechTextConverter's pool
+_worker_tts = None
+
+
+def _init_worker(speed: float, voice: str, torch_threads: int=None) -> None:
+    global _worker_tts
+    _worker_tts = SpeechTextConverter(speed=speed, torch_threads=torch_threads)
+    _worker_tts.voice = voice
+
 
-    def str_to_audio(self, text: str) -> tuple:
-        generator = self.pipeline(
-            text,
-            voice=self.voice,
-            speed=self.speed,
-            split_pattern=None
-        )
-        for gs, ps, audio in generator:
-            sr = 24000
-            if audio is not None:
-                return sr, audio
-        raise Exception('Audio generation failed')
+def _synthesize_in_worker(text: str) -> tuple:
+    sr, audio = _worker_tts._synthesize(text)
+    return sr, np.asarray(audio, dtype=np.float32)
 
 
 def preprocess_text(text: str) -> str:
@@ -41,7 +181,9 @@ def preprocess_text(text: str) -> str:
 
 
 def save_audio_to_file(audio_data: np.ndarray, sr: int, file_path: str) -> None:
-    sf.write(file_path, audio_data, sr)
+    with span('audio_save', file=os.path.basename(file_path)) as s:
+        sf.write(file_path, audio_data, sr)
+        s.add_output(file_path)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,18 @@
+import os
+import tempfile
+import threading
+import subprocess
 import numpy as np
+from typing import Callable, Iterator
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import soundfile as sf
+from PIL import Image
 from moviepy.video.VideoClip import VideoClip
 from moviepy.audio.AudioClip import AudioClip, AudioArrayClip
 from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
+from utils.profiling import span
+from utils.limits import limit
 
 
 """
@@ -9,9 +20,38 @@ This module is responsible for any actions related to videos
 """
 
 
+# silence after the narration of each slide, in seconds
+SLIDE_PADDING = 1.5
+
+
+class FrameStore:
+    """
+    Keeps slides on disk (one png per slide) instead of in memory,
+    frames are only loaded when needed, one at a time.
+    """
+    def __init__(self, store_dir: str) -> None:
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def path(self, i: int) -> str:
+        return os.path.join(self.store_dir, f'{i}.png')
+
+    def put(self, i: int, image: Image.Image) -> str:
+        path = self.path(i)
+        with span('frame_save', slide=str(i)) as s:
+            image.save(path)
+            s.add_output(path)
+        return path
+
+    def get(self, i: int) -> np.ndarray:
+        with Image.open(self.path(i)) as image:
+            return np.asarray(image.convert('RGB'))
+
+
 def merge_audios(audios: list[np.ndarray], sr: int, silent_separator: float=0.5) -> AudioClip:
     # Merge audios with silence in between
-    merged_audio = np.concatenate(audios)
+    with span('audio_merge', slides=len(audios)):
+        merged_audio = np.concatenate(audios)
     # Ensure it's in the correct shape for MoviePy (2D array with shape (num_samples, 1))
     merged_audio = merged_audio.reshape(-1, 1)
     # Create an AudioClip from the merged audio array
@@ -20,7 +60,8 @@ def merge_audios(audios: list[np.ndarray], sr: int, silent_separator: float=0.5)
     return full_audio
 
 
-def create_image_sequence(images: list[np.ndarray], durations: list[float]) -> ImageSequenceClip:
+def create_image_sequence(images: list[np.ndarray] | list[str], durations: list[float]) -> ImageSequenceClip:
+    # given file paths, moviepy loads each frame lazily
     return ImageSequenceClip(sequence=images, durations=durations)
 
 
@@ -29,10 +70,10 @@ def concat_video_audio(video: VideoClip, audio: AudioClip) -> VideoClip:
 
 
 def get_audio_length(audio_np: np.ndarray, sr: int) -> float:
-    return (audio_np.shape[0] / sr) + 1.5
+    return (audio_np.shape[0] / sr) + SLIDE_PADDING
 
 
-def merge_all(audios: list[np.ndarray], images: list[np.ndarray], sr: int) -> VideoClip:
+def merge_all(audios: list[np.ndarray], images: list[np.ndarray] | list[str], sr: int) -> VideoClip:
     full_audio = merge_audios(audios, sr=sr, silent_separator=0.5)
     images_durations = [get_audio_length(audio_np, sr) for audio_np in audios]
     images_video = create_image_sequence(images, images_durations)
@@ -41,4 +82,155 @@ def merge_all(audios: list[np.ndarray], images: list[np.ndarray], sr: int) -> Vi
 
 
 def save_video(video: VideoClip, output_path: str) -> None:
-    video.write_videofile(output_path, codec='libx264', audio_codec='aac')
+    with limit('encode'), span('encode', encoder='moviepy', file=os.path.basename(output_path)) as s:
+        video.write_videofile(output_path, codec='libx264', audio_codec='aac')
+        s.add_output(output_path)
+
+
+def get_ffmpeg_exe() -> str:
+    # moviepy ships its own ffmpeg through imageio-ffmpeg, fallback to the one on PATH
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return 'ffmpeg'
+
+
+def pad_audios(audios: list[np.ndarray], sr: int, durations: list[float]) -> np.ndarray:
+    """Merges audios into one track, each padded with silence to the duration of its slide"""
+    with span('audio_merge', slides=len(audios)):
+        lengths = [int(round(duration * sr)) for duration in durations]
+        merged_audio = np.zeros(sum(lengths), dtype=np.float32)
+        position = 0
+        for audio_np, length in zip(audios, lengths):
+            audio_np = np.asarray(audio_np, dtype=np.float32).reshape(-1)[:length]
+            merged_audio[position:position + len(audio_np)] = audio_np
+            position += length
+    return merged_audio
+
+
+def encode_slideshow(
+    image_paths: list[str],
+    audios: list[np.ndarray],
+    sr: int,
+    output_path: str,
+    crf: int=23,
+    preset: str='veryfast',
+    threads: int=0,
+    encoded_audio: str=None
+) -> str:
+    """
+    Encodes still slides + their audios into a video with ffmpeg's concat demuxer.
+    Every image is decoded & encoded once (variable frame rate, x264 still-image tuning),
+    so encoding time depends on the number of slides, not on the video duration.
+    encoded_audio is the track already encoded by open_audio_encoder, copied as is (audios only give the durations).
+    """
+    durations = [get_audio_length(audio_np, sr) for audio_np in audios]
+    with tempfile.TemporaryDirectory(prefix='slideshow_') as work_dir:
+        # concat list, last image repeated so its duration is applied
+        list_path = os.path.join(work_dir, 'slides.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for image_path, duration in zip(image_paths, durations):
+                f.write(f"file '{os.path.abspath(image_path)}'\nduration {duration:.3f}\n")
+            f.write(f"file '{os.path.abspath(image_paths[-1])}'\n")
+        audio_path = encoded_audio
+        if audio_path is None:
+            audio_path = os.path.join(work_dir, 'audio.wav')
+            sf.write(audio_path, pad_audios(audios, sr, durations), sr)
+        command = [
+            get_ffmpeg_exe(), '-y', '-v', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-i', audio_path,
+            '-c:v', 'libx264', '-tune', 'stillimage', '-preset', preset, '-crf', str(crf),
+            '-pix_fmt', 'yuv420p', '-fps_mode', 'vfr', '-threads', str(threads),
+            '-c:a', 'aac' if encoded_audio is None else 'copy', '-movflags', '+faststart',
+            output_path
+        ]
+        with limit('encode'), span(
+            'encode', encoder='ffmpeg', slides=len(image_paths), file=os.path.basename(output_path)
+        ) as s:
+            subprocess.run(command, check=True, capture_output=True)
+            s.add_output(output_path)
+    return output_path
+
+
+@contextmanager
+def open_audio_encoder(output_path: str, sr: int, padding: float=SLIDE_PADDING) -> Iterator[Callable[[np.ndarray], None]]:
+    """
+    Yields a function piping float32 audio chunks into ffmpeg's aac encoder, so an audio is encoded while
+    it is synthesized. padding seconds of silence are appended, like pad_audios does for a slide.
+    """
+    command = [
+        get_ffmpeg_exe(), '-y', '-v', 'error',
+        '-f', 'f32le', '-ar', str(sr), '-ac', '1', '-i', 'pipe:0',
+        '-c:a', 'aac', output_path
+    ]
+
+    def write(chunk: np.ndarray) -> None:
+        process.stdin.write(np.asarray(chunk, dtype='<f4').tobytes())
+
+    with span('audio_encode', file=os.path.basename(output_path), streamed=True) as s:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            yield write
+            write(np.zeros(int(round(padding * sr)), dtype=np.float32))
+        except BaseException:
+            process.kill()
+            process.communicate()
+            raise
+        _, stderr = process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+        s.add_output(output_path)
+
+
+def encode_segments(
+    image_paths: list[str],
+    audios: list[np.ndarray],
+    sr: int,
+    segment_paths: list[str],
+    max_workers: int=None,
+    on_encoded: Callable[[str], None]=None,
+    cancel: threading.Event=None
+) -> list[str]:
+    """
+    Encodes every slide with its own audio into an independent segment, several segments at once.
+    on_encoded is called with each segment path once written, segments not started when cancel is set are skipped (None).
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    # share the cores between concurrent encoders
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+
+    def encode(image_path: str, audio_np: np.ndarray, segment_path: str) -> str | None:
+        if cancel is not None and cancel.is_set():
+            return None
+        encode_slideshow([image_path], [audio_np], sr, segment_path, threads=threads)
+        if on_encoded is not None:
+            on_encoded(segment_path)
+        return segment_path
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(encode, image_path, audio_np, segment_path)
+            for image_path, audio_np, segment_path in zip(image_paths, audios, segment_paths)
+        ]
+        return [future.result() for future in futures]
+
+
+def concat_segments(segment_paths: list[str], output_path: str) -> str:
+    """Joins segments encoded with the same settings, streams are copied (no re-encoding)"""
+    with tempfile.TemporaryDirectory(prefix='concat_') as work_dir:
+        list_path = os.path.join(work_dir, 'segments.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for segment_path in segment_paths:
+                f.write(f"file '{os.path.abspath(segment_path)}'\n")
+        command = [
+            get_ffmpeg_exe(), '-y', '-v', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c', 'copy', '-movflags', '+faststart',
+            output_path
+        ]
+        with limit('encode'), span('concat', segments=len(segment_paths)) as s:
+            subprocess.run(command, check=True, capture_output=True)
+            s.add_output(output_path)
+    return output_path
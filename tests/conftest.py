@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# modules are imported the way the app runs them, from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
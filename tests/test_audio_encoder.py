@@ -0,0 +1,38 @@
+import re
+import pytest
+import subprocess
+import numpy as np
+from PIL import Image
+from utils.video_utils import open_audio_encoder, encode_slideshow, get_ffmpeg_exe
+
+
+SR = 24000
+
+
+def get_duration(path: str) -> float:
+    stderr = subprocess.run([get_ffmpeg_exe(), '-i', path], capture_output=True, text=True).stderr
+    hours, minutes, seconds = re.search(r'Duration: (\d+):(\d+):([\d.]+)', stderr).groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def test_streamed_audio_segment_matches_encoded_one(tmp_path):
+    image_path = str(tmp_path / 'slide.png')
+    Image.new('RGB', (64, 64), 'white').save(image_path)
+    chunks = [np.full(SR // 2, 0.1, dtype=np.float32) for _ in range(3)]
+    audio_np = np.concatenate(chunks)
+    audio_path = str(tmp_path / 'slide.m4a')
+    with open_audio_encoder(audio_path, SR) as write_chunk:
+        for chunk in chunks:
+            write_chunk(chunk)
+    streamed = encode_slideshow([image_path], [audio_np], SR, str(tmp_path / 'streamed.mp4'), encoded_audio=audio_path)
+    encoded = encode_slideshow([image_path], [audio_np], SR, str(tmp_path / 'encoded.mp4'))
+    assert abs(get_duration(streamed) - get_duration(encoded)) < 0.05
+    assert abs(get_duration(audio_path) - 3.0) < 0.05
+
+
+def test_failed_synthesis_stops_encoder(tmp_path):
+    audio_path = str(tmp_path / 'slide.m4a')
+    with pytest.raises(RuntimeError, match='synthesis failed'):
+        with open_audio_encoder(audio_path, SR) as write_chunk:
+            write_chunk(np.zeros(SR, dtype=np.float32))
+            raise RuntimeError('synthesis failed')
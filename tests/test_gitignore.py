@@ -0,0 +1,54 @@
+import os
+from utils.explainer.codebase_parser import GitIgnore, list_files
+
+
+def make_gitignore(tmp_path, content: str, base: str='') -> GitIgnore:
+    path = tmp_path / '.gitignore'
+    path.write_text(content)
+    gitignore = GitIgnore()
+    gitignore.add_file(str(path), base)
+    return gitignore
+
+
+def test_anchored_dir_only(tmp_path):
+    gitignore = make_gitignore(tmp_path, '/build/\n')
+    assert gitignore.is_ignored('build', is_dir=True)
+    assert not gitignore.is_ignored('src/build', is_dir=True)
+    assert not gitignore.is_ignored('build', is_dir=False)
+
+
+def test_unanchored_dir_only(tmp_path):
+    gitignore = make_gitignore(tmp_path, 'build/\n')
+    assert gitignore.is_ignored('build', is_dir=True)
+    assert gitignore.is_ignored('src/build', is_dir=True)
+    assert not gitignore.is_ignored('src/build', is_dir=False)
+
+
+def test_anchored_by_middle_slash(tmp_path):
+    gitignore = make_gitignore(tmp_path, 'docs/*.md\n')
+    assert gitignore.is_ignored('docs/a.md', is_dir=False)
+    assert not gitignore.is_ignored('src/docs/a.md', is_dir=False)
+
+
+def test_unanchored_file(tmp_path):
+    gitignore = make_gitignore(tmp_path, '*.log\n!keep.log\n')
+    assert gitignore.is_ignored('a/b/c.log', is_dir=False)
+    assert not gitignore.is_ignored('a/keep.log', is_dir=False)
+
+
+def test_nested_gitignore_is_relative_to_its_folder(tmp_path):
+    gitignore = make_gitignore(tmp_path, '/out/\n', base='pkg')
+    assert gitignore.is_ignored('pkg/out', is_dir=True)
+    assert not gitignore.is_ignored('pkg/sub/out', is_dir=True)
+    assert not gitignore.is_ignored('out', is_dir=True)
+
+
+def test_list_files_keeps_nested_folder_of_anchored_rule(tmp_path):
+    # not a folder ignored by default (like build)
+    for rel_path in ('generated/a.py', 'src/generated/b.py', 'src/c.py'):
+        os.makedirs(tmp_path / os.path.dirname(rel_path), exist_ok=True)
+        (tmp_path / rel_path).write_text('x = 1\n')
+    (tmp_path / '.gitignore').write_text('/generated/\n')
+    files = {os.path.relpath(path, tmp_path).replace(os.sep, '/') for path in list_files(str(tmp_path), [])}
+    assert files >= {'src/generated/b.py', 'src/c.py'}
+    assert 'generated/a.py' not in files
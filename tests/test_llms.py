@@ -0,0 +1,37 @@
+import json
+from utils.explainer.llms import iter_json_array, parse_response
+
+
+EXPLANATIONS = [
+    {'file_path': 'a.py', 'explanatory_text': 'Reads [the] config', 'start_line': 1, 'end_line': 3},
+    {'file_path': 'b.py', 'explanatory_text': 'Says "hi" \\ bye', 'start_line': 4, 'end_line': 9},
+]
+
+
+def chunked(text: str, size: int=7) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_plain_array():
+    assert list(iter_json_array(chunked(json.dumps(EXPLANATIONS)))) == EXPLANATIONS
+
+
+def test_fenced_array_after_preamble_with_brackets():
+    text = f'Sure, here are the [20] explanations:\n```json\n{json.dumps(EXPLANATIONS, indent=2)}\n```'
+    assert list(iter_json_array(chunked(text))) == EXPLANATIONS
+    # same answer as the non-streaming parser
+    assert list(iter_json_array([text])) == parse_response(text)
+
+
+def test_unfenced_array_after_preamble_with_brackets():
+    text = f'Explanations [1-2] below: {json.dumps(EXPLANATIONS)}'
+    assert list(iter_json_array(chunked(text, 3))) == EXPLANATIONS
+
+
+def test_fence_split_across_chunks():
+    text = f'[draft] ```json\n{json.dumps(EXPLANATIONS)}\n```'
+    assert list(iter_json_array(chunked(text, 2))) == EXPLANATIONS
+
+
+def test_no_array():
+    assert list(iter_json_array(['I cannot [really] help with that.'])) == []
@@ -0,0 +1,59 @@
+import os
+import threading
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer
+import pytest
+from utils.media_server import MediaHandler
+
+
+NAME = 'ab' * 16 + '.mp4'
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def server_url(tmp_path):
+    (tmp_path / NAME).write_bytes(DATA)
+    (tmp_path / 'secret.txt').write_text('x')
+    handler = type('TestMediaHandler', (MediaHandler,), {'directory': str(tmp_path)})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def get(url: str, headers: dict=None):
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}))
+
+
+def test_full_file(server_url):
+    response = get(f'{server_url}/{NAME}')
+    assert response.status == 200
+    assert response.headers['Content-Type'] == 'video/mp4'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.read() == DATA
+
+
+def test_ranges(server_url):
+    response = get(f'{server_url}/{NAME}', {'Range': 'bytes=100-199'})
+    assert response.status == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+    assert response.read() == DATA[100:200]
+    assert get(f'{server_url}/{NAME}', {'Range': 'bytes=10000-'}).read() == DATA[10000:]
+    assert get(f'{server_url}/{NAME}', {'Range': 'bytes=-16'}).read() == DATA[-16:]
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(f'{server_url}/{NAME}', {'Range': f'bytes={len(DATA)}-'})
+    assert error.value.code == 416
+
+
+def test_download(server_url):
+    response = get(f'{server_url}/{NAME}?download')
+    assert response.headers['Content-Disposition'].startswith('attachment')
+
+
+@pytest.mark.parametrize('path', ['/secret.txt', '/../' + NAME, '/' + NAME.upper(), '/'])
+def test_only_published_names(server_url, path):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(f'{server_url}{path}')
+    assert error.value.code == 404
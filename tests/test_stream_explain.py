@@ -0,0 +1,38 @@
+from utils.explainer import _stream_explain
+from utils.explainer.llms import LLM
+from utils.explainer.codebase_parser import CodebaseSnapshot
+
+
+EXPLANATION = {'file_path': 'a.py', 'explanatory_text': 'x', 'start_line': 1, 'end_line': 1}
+
+
+class FakeLLM(LLM):
+    """Streams `streamed`, answers `answer` without streaming"""
+    model = 'test'
+
+    def __init__(self, streamed: str, answer: str) -> None:
+        self.streamed = streamed
+        self.answer = answer
+        self.calls = 0
+
+    def generate_stream(self, prompt: str):
+        yield from (self.streamed[i:i + 5] for i in range(0, len(self.streamed), 5))
+
+    def generate_text(self, prompt: str) -> str:
+        self.calls += 1
+        return self.answer
+
+
+def test_streamed_array_after_bracketed_preamble():
+    llm = FakeLLM('Sure, here are the [20] explanations:\n```json\n[{"file_path": "a.py", '
+                  '"explanatory_text": "x", "start_line": 1, "end_line": 1}]\n```', '')
+    assert list(_stream_explain(llm, CodebaseSnapshot(), '', 1, '')) == [EXPLANATION]
+    assert llm.calls == 0
+
+
+def test_fallback_when_stream_has_no_objects():
+    llm = FakeLLM('```json\n[20]\n```', f'```json\n[{{"file_path": "a.py", "explanatory_text": "x", '
+                                         f'"start_line": 1, "end_line": 1}}]\n```')
+    items = list(_stream_explain(llm, CodebaseSnapshot(), '', 1, ''))
+    assert [item for item in items if isinstance(item, dict)] == [EXPLANATION]
+    assert llm.calls == 1